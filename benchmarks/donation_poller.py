@@ -0,0 +1,98 @@
+'''
+Runs events.extralife.DonationPoller against a local stand-in for the Extra Life donations endpoint and checks the
+conditional request, incremental, backoff and malformed response paths, printing the poll interval after each step.
+Run from the repository root with a config.py present: python benchmarks/donation_poller.py
+'''
+
+import asyncio
+import os
+import sys
+
+import aiohttp
+from aiohttp import web
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord.ext.commands  # noqa: E402, tools expects discord.ext to already be imported
+
+import tools  # noqa: E402
+from events.extralife import DonationPoller  # noqa: E402
+
+
+class DonationServer:
+    '''Serves a newest-first donation list with an ETag, or a canned status/body when one is set'''
+
+    def __init__(self):
+        self.donations = []
+        self.override = None  # (status, body)
+        self.requests = 0
+
+    def add(self, donationID):
+        self.donations.insert(0, {'donationID': donationID, 'createdDateUTC': '2020-11-07T06:00:07.327+0000'})
+
+    async def handle(self, request):
+        self.requests += 1
+        if self.override:
+            status, body = self.override
+            return web.Response(status=status, text=body, content_type='text/html')
+
+        etag = f'"{len(self.donations)}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304)
+
+        return web.json_response(self.donations, headers={'ETag': etag})
+
+
+async def main():
+    server = DonationServer()
+    app = web.Application()
+    app.router.add_get('/donations', server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    client = tools.HTTPClient(backoff=0)
+    await client.start()
+    poller = DonationPoller(client, f'http://127.0.0.1:{port}/donations')
+
+    async def step(name, expected):
+        donations = await poller.poll()
+        ids = [x['donationID'] for x in donations]
+        assert ids == expected, f'{name}: expected {expected}, got {ids}'
+        print(f'{name:<32} new={ids} interval={poller.interval}s requests={server.requests}')
+
+    try:
+        server.add('a')
+        await step('first poll, no saved donation', [])
+        await step('unchanged, 304', [])
+        server.add('b')
+        server.add('c')
+        await step('two new donations', ['b', 'c'])
+        assert poller.interval == DonationPoller.MIN_INTERVAL
+
+        server.override = (200, '<html>Service Unavailable</html>')
+        await step('HTML body with status 200', [])
+        server.override = (200, '{"error": "maintenance"}')
+        await step('JSON body that is not a list', [])
+        server.override = None
+        server.add('d')
+        await step('recovered', ['d'])
+
+        server.override = (404, 'Not Found')
+        try:
+            await poller.poll()
+            raise AssertionError('404 did not raise')
+
+        except aiohttp.ClientResponseError as e:
+            print(f'{"404 raises":<32} {e.status} interval={poller.interval}s')
+
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
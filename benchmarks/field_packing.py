@@ -0,0 +1,75 @@
+'''
+Compares tools.iter_fields against the previous pop(0) based convert_list_to_fields on member-listing sized inputs.
+Run from the repository root with a config.py present: python benchmarks/field_packing.py
+'''
+
+import os
+import sys
+import time
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord.ext.commands  # noqa: E402, tools expects discord.ext to already be imported
+
+import tools  # noqa: E402
+
+
+LINE_COUNTS = [10_000, 100_000, 1_000_000]
+LEGACY_MAX_LINES = 100_000  # The old packer is quadratic, past this it takes minutes
+
+
+def legacy_convert_list_to_fields(lines, codeblock=True):
+    fields = []
+
+    while lines:
+        value = '```' if codeblock else ''
+
+        for line in lines.copy():
+            staged = value + line + '\n'
+            if len(staged) + (3 if codeblock else 0) > 1024:
+                break
+
+            lines.pop(0)
+            value = staged
+
+        value += '```' if codeblock else ''
+        fields.append({'name': '\uFEFF', 'value': value, 'inline': False})
+
+    return fields
+
+
+def member_lines(count):
+    return [f'* ExampleUser{i} ({175000000000000000 + i})' for i in range(count)]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    print(f'{"lines":>10} {"fields":>8} {"iter_fields":>12} {"first page":>11} {"legacy":>10}')
+    for count in LINE_COUNTS:
+        lines = member_lines(count)
+        elapsed, fields = timed(lambda x: list(tools.iter_fields(x)), lines)
+
+        # Time to the first paginator page (25 fields), what a user waits on when fields are streamed
+        start = time.perf_counter()
+        packer = tools.iter_fields(iter(lines))
+        for _ in zip(range(25), packer):
+            pass
+        first_page = time.perf_counter() - start
+
+        legacy = '-'
+        if count <= LEGACY_MAX_LINES:
+            legacy_elapsed, legacy_fields = timed(legacy_convert_list_to_fields, list(lines))
+            assert [x['value'] for x in legacy_fields] == [x['value'] for x in fields]
+            legacy = f'{legacy_elapsed:.3f}s'
+
+        print(f'{count:>10} {len(fields):>8} {elapsed:>11.3f}s {first_page * 1000:>9.2f}ms {legacy:>10}')
+
+
+if __name__ == '__main__':
+    main()
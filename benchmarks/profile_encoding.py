@@ -0,0 +1,66 @@
+'''
+Reports encode time and output size of each tools.IMAGE_ENCODINGS option for a 1600x900 profile card composited from
+every background in resources/profiles/backgrounds.yml.
+Run from the repository root with a config.py present: python benchmarks/profile_encoding.py [rounds]
+'''
+
+import collections
+import os
+import sys
+import time
+
+import yaml
+from PIL import Image
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord.ext.commands  # noqa: E402, tools expects discord.ext to already be imported
+
+import tools  # noqa: E402
+
+
+PROFILES = 'resources/profiles'
+
+
+def compose_card(name, background):
+    '''Approximates a profile card: theme base, background, then the trophy case overlay'''
+    theme = background['theme']
+    card = Image.open(f'{PROFILES}/layout/{theme}/pfp-background.png').convert('RGBA')
+    image = Image.open(f'{PROFILES}/backgrounds/{name}.png').convert('RGBA')
+    trophyBg = Image.open(f'{PROFILES}/layout/{theme}/trophy-bg/{background["trophy-bg-opacity"]}.png').convert('RGBA')
+    image = Image.alpha_composite(image, trophyBg.resize(image.size))
+    card.paste(image, mask=image)
+    return card
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    with open(f'{PROFILES}/backgrounds.yml') as stream:
+        backgrounds = yaml.safe_load(stream)
+
+    cards = [compose_card(name, bg) for name, bg in backgrounds.items()]
+    times = collections.defaultdict(list)
+    sizes = collections.defaultdict(list)
+
+    for card in cards:
+        for encoding in tools.IMAGE_ENCODINGS:
+            for _ in range(rounds):
+                start = time.perf_counter()
+                file = tools.encode_image(card, 'profile', encoding)
+                times[encoding].append(time.perf_counter() - start)
+
+            sizes[encoding].append(len(file.fp.getvalue()))
+
+    print(f'{len(cards)} backgrounds, {rounds} rounds each')
+    print(f'{"encoding":<15} {"avg ms":>8} {"max ms":>8} {"avg KiB":>9} {"max KiB":>9}')
+    for encoding in tools.IMAGE_ENCODINGS:
+        t, s = times[encoding], sizes[encoding]
+        print(
+            f'{encoding:<15} {sum(t) / len(t) * 1000:>8.1f} {max(t) * 1000:>8.1f} '
+            f'{sum(s) / len(s) / 1024:>9.1f} {max(s) / 1024:>9.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
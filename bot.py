@@ -1,5 +1,7 @@
 import asyncio
 import logging
+import resource
+import time
 from sys import exit
 
 import discord
@@ -31,6 +33,7 @@ intents = discord.Intents(
     messages=True,
     message_content=True,
     reactions=True,
+    webhooks=True,  # ChatControl drops its cached webhooks on webhook updates
 )
 
 
@@ -43,35 +46,78 @@ class BotCache(commands.Cog):
     async def on_ready(self):
         logging.info('[Bot] on_ready')
         if not self.READY:
+            self.bot.log_startup_metrics('ready')
             await self.bot.load_extension('modules.core')
             # self.READY = True
             # return
-            logging.info('[Cache] Performing initial database synchronization')
-            db = mclient.bowser.users
             NS = self.bot.get_guild(config.nintendoswitch)
+            if config.lazyMembers:
+                # Members are fetched on demand until the background chunk finishes, sync once we have them all
+                asyncio.create_task(self.chunk_and_sync(NS))
 
-            guildCount = len(NS.members)
-            userCount = 0
-            for member in NS.members:
-                userCount += 1
-                logging.debug(f'[Cache] Syncronizing user {userCount}/{guildCount}')
-                doc = db.find_one({'_id': member.id})
-                if not doc:
-                    await tools.store_user(member)
-                    continue
+            else:
+                await self.sync_members(NS)
 
-                roleList = []
-                for role in member.roles:
-                    if role.id != NS.id:
-                        roleList.append(role.id)
+            self.READY = True
 
-                if roleList == doc['roles']:
-                    continue
+    async def chunk_and_sync(self, guild):
+        await guild.chunk()
+        self.bot.log_startup_metrics('background member chunk complete')
+        await self.sync_members(guild)
 
-                db.update_one({'_id': member.id}, {'$set': {'roles': roleList}})
+    async def sync_members(self, NS):
+        self.bot.roleIndex.build(NS)
+        await self.bot.names.load(NS)
+        logging.info('[Cache] Performing initial database synchronization')
+        db = mclient.bowser.users
 
-            logging.info('[Cache] Inital database syncronization complete')
-            self.READY = True
+        guildCount = len(NS.members)
+        userCount = 0
+        for member in NS.members:
+            userCount += 1
+            logging.debug(f'[Cache] Syncronizing user {userCount}/{guildCount}')
+            doc = db.find_one({'_id': member.id})
+            if not doc:
+                await tools.store_user(member)
+                continue
+
+            roleList = []
+            for role in member.roles:
+                if role.id != NS.id:
+                    roleList.append(role.id)
+
+            if roleList == doc['roles']:
+                continue
+
+            db.update_one({'_id': member.id}, {'$set': {'roles': roleList}})
+
+        logging.info('[Cache] Inital database syncronization complete')
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        self.bot.names.add_user(member)
+        self.bot.roleIndex.add_member(member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        self.bot.roleIndex.remove_member(member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.nick != after.nick:
+            self.bot.names.add_user(after)
+
+        if before.roles != after.roles:
+            self.bot.roleIndex.update_member(before, after)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        self.bot.roleIndex.remove_role(role)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        if before.name != after.name or before.global_name != after.global_name:
+            self.bot.names.add_user(after)
 
 
 class AutomodSubstitute(commands.Cog):
@@ -81,14 +127,14 @@ class AutomodSubstitute(commands.Cog):
         self.bot = bot
         self.READY = False
         self.antispam_loaded = False
+        bot.pipeline.register('AutomodSubstitute', self.process_message, priority=10)
 
     def set_antispam_loaded(self):
         self.antispam_loaded = True
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
+    async def process_message(self, message, parsed):
         if not self.antispam_loaded:
-            await self.bot.get_cog('Utility Commands').on_automod_finished(message)
+            await self.bot.get_cog('Utility Commands').on_automod_finished(message, parsed)
 
 
 async def safe_send_message(channel, content=None, embeds=None):
@@ -101,7 +147,7 @@ class MechaBowser(commands.Bot):
             activity=discord.Activity(type=discord.ActivityType.watching, name='over the server'),
             case_insensitive=True,
             command_prefix=config.command_prefixes,
-            chunk_guilds_at_startup=True,
+            chunk_guilds_at_startup=not config.lazyMembers,
             intents=discord.Intents(
                 guilds=True,
                 members=True,
@@ -112,22 +158,57 @@ class MechaBowser(commands.Bot):
                 messages=True,
                 message_content=True,
                 reactions=True,
+                webhooks=True,  # ChatControl drops its cached webhooks on webhook updates
             ),
-            max_messages=300000,
+            max_messages=config.maxMessages,  # Delete and edit logs use the compact messageCache instead
         )
 
+        self.startTime = time.monotonic()
+        self.names = tools.NameIndex()
+        self.roleIndex = tools.RoleIndex()
+        self.resolver = tools.UserResolver(self)
+        self.web = tools.HTTPClient()  # Every outbound HTTP request goes through this client
         if config.DSN:
             from discord_sentry_reporting import use_sentry
 
             use_sentry(self, dsn=config.DSN, traces_sample_rate=1.0, environment='production')
 
+        self.sanctions = tools.ActiveSanctions()
+        self.pipeline = tools.MessagePipeline(self)  # Parses messages once for every on_message consumer, see dispatch
+        self.reactions = tools.ReactionDispatcher()
+        self.purgedMessages = tools.TTLCache(600)  # Message IDs selected by !clean, so bulk delete logs skip them
+        self.messageCache = tools.MessageCache(
+            config.messageCacheBytes, config.messageCacheSpill, config.messageCacheSpillAge
+        )
+
     async def setup_hook(self):
+        self.sanctions.load()
+        await self.web.start()
         await self.add_cog(BotCache(self))
         await self.add_cog(AutomodSubstitute(self))
         await self.load_extension('jishaku')
 
+    async def close(self):
+        await super().close()
+        await self.web.close()
+        self.messageCache.flush()
+
+    def log_startup_metrics(self, stage):
+        # ru_maxrss is reported in KiB on Linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        mode = 'lazy' if config.lazyMembers else 'startup'
+        logging.info(
+            f'[Bot] {stage.capitalize()} after {time.monotonic() - self.startTime:.1f}s, '
+            f'peak RSS {rss:.0f} MiB ({mode} member chunking)'
+        )
+
     async def on_message(self, message):
-        return  # Return so commands will not process, and main extension can process instead
+        # Commands are not processed here, the main extension's pipeline consumer processes them instead
+        await self.pipeline.dispatch(message)
+
+    async def on_raw_reaction_add(self, payload):
+        if payload.user_id != self.user.id:
+            await self.reactions.dispatch(payload)
 
 
 if __name__ == '__main__':
@@ -85,6 +85,19 @@ banAppealInvite: str = invite_to_ban_appeal_server
 
 # Web
 baseUrl = 'https://example.com'
+
+# Member caching
+lazyMembers = False  # Skip member chunking at startup and instead chunk in the background after ready
+
+# Profile cards
+profileEncoding = 'png'  # One of tools.IMAGE_ENCODINGS: png, png-fast, png-palette, webp or webp-lossless
+
+# Message caching
+maxMessages = 1000  # discord.py's own cache of full message objects
+messageCacheBytes = 64 * 1024 * 1024  # Memory budget of the compact cache used by delete and edit logs
+messageCacheSpill = None  # Path to a sqlite file evicted messages spill to, or None to disable
+messageCacheSpillAge = 60 * 60 * 24 * 7  # Seconds spilled messages are kept for
+
 # Text constants
 punDM = (
     'You have received a moderation action on the /r/NintendoSwitch Discord server.\n'
@@ -11,6 +11,7 @@ from discord.ext import commands
 class ChatRoleEvent(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.bot.pipeline.register('ChatRoleEvent', self.process_message, priority=30)
         self.active = False
         self.role = None
         self.notify = None
@@ -114,8 +115,10 @@ class ChatRoleEvent(commands.Cog):
             )
             raise error
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
+    def cog_unload(self):
+        self.bot.pipeline.unregister('ChatRoleEvent')
+
+    async def process_message(self, message, parsed):
         if not self.active or message.author.bot or isinstance(message.channel, discord.channel.DMChannel):
             return
 
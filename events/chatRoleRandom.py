@@ -13,6 +13,7 @@ from discord.ext import commands
 class ChatRoleRandomEvent(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.bot.pipeline.register('ChatRoleRandomEvent', self.process_message, priority=30)
         self.roles = []
 
     @commands.has_any_role(config.moderator, config.eh)
@@ -60,8 +61,10 @@ class ChatRoleRandomEvent(commands.Cog):
             )
             raise error
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
+    def cog_unload(self):
+        self.bot.pipeline.unregister('ChatRoleRandomEvent')
+
+    async def process_message(self, message, parsed):
         if not self.roles or message.author.bot or isinstance(message.channel, discord.channel.DMChannel):
             return
 
@@ -1,17 +1,109 @@
+import asyncio
 import logging
 import re
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
+import aiohttp
 import config
 import discord
 import pymongo
-import requests
 from discord.ext import commands, tasks
 
 import tools
 
 
+class DonationPoller:
+    '''
+    Polls the Extra Life donations endpoint with conditional requests and returns only donations newer than the last
+    seen donationID. The interval shortens while donations are coming in, doubles while nothing changes (capped lower
+    when the stream is live) and backs off further on errors
+    '''
+
+    MIN_INTERVAL = 10
+    LIVE_INTERVAL = 30
+    IDLE_INTERVAL = 120
+    ERROR_INTERVAL = 300
+
+    def __init__(self, web: tools.HTTPClient, url: str, last_id: Optional[str] = None):
+        self.web = web
+        self.url = url
+        self.lastDonationID = last_id
+        self.etag = None
+        self.lastModified = None
+        self.live = False
+        self.interval = self.MIN_INTERVAL
+
+    def set_live(self, live: bool):
+        self.live = live
+        self.interval = self.MIN_INTERVAL
+
+    def _no_change(self):
+        self.interval = min(self.interval * 2, self.LIVE_INTERVAL if self.live else self.IDLE_INTERVAL)
+
+    async def poll(self) -> List[dict]:
+        '''
+        Returns new donations, oldest first. Raises aiohttp.ClientError or asyncio.TimeoutError if the request fails.
+        A response that is not a JSON list of donations is logged and treated as an empty poll
+        '''
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.lastModified:
+            headers['If-Modified-Since'] = self.lastModified
+
+        try:
+            resp = await self.web.request(
+                'GET', self.url, headers=headers, retries=1, timeout=aiohttp.ClientTimeout(total=8)
+            )
+
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.interval = min(self.interval * 2, self.ERROR_INTERVAL)
+            raise
+
+        if resp.status == 304:
+            self._no_change()
+            return []
+
+        try:
+            donations = resp.json()
+
+        except aiohttp.ClientResponseError as e:  # The body was not JSON, such as an HTML error page
+            logging.warning(f'[ExtraLife] Skipping donation poll with an undecodable response: {e}')
+            self.interval = min(self.interval * 2, self.ERROR_INTERVAL)
+            return []
+
+        if not isinstance(donations, list):
+            logging.warning(f'[ExtraLife] Skipping donation poll with an unexpected response: {str(donations)[:200]}')
+            self.interval = min(self.interval * 2, self.ERROR_INTERVAL)
+            return []
+
+        # Validators are only kept for a response we could use, so a bad body is not revalidated as unchanged
+        self.etag = resp.headers.get('ETag')
+        self.lastModified = resp.headers.get('Last-Modified')
+        if not donations:
+            self._no_change()
+            return []
+
+        newDonations = []
+        if self.lastDonationID is not None:  # If we have no saved donation, assume we're upto date
+            for donation in donations:
+                if donation['donationID'] == self.lastDonationID:
+                    break
+
+                newDonations.append(donation)
+
+        self.lastDonationID = donations[0]['donationID']
+        if newDonations:
+            self.interval = self.MIN_INTERVAL
+
+        else:
+            self._no_change()
+
+        newDonations.reverse()
+        return newDonations
+
+
 class ExtraLife(commands.Cog):
     def __init__(self, bot):
         ################################################################################################################################
@@ -50,19 +142,33 @@ class ExtraLife(commands.Cog):
         self.donations = self.guild.get_channel(self.DONATIONS)
         self.chatRole = self.guild.get_role(self.CHAT_ROLE)
         self.donorRole = self.guild.get_role(self.DONOR_ROLE)
-        self.lastDonationID = None
+        self.poller = DonationPoller(self.bot.web, self.DONATIONS_URL)
 
         self.donation_check.start()
+        self.bot.pipeline.register('ExtraLife', self.process_message, priority=30)
 
     @commands.command(name='ldi')
     @commands.check_any(commands.is_owner(), commands.has_guild_permissions(administrator=True))
     async def lastdonorid(self, ctx, string: str = None):
         if string is None:
-            return await ctx.send(content=f'Last donation id is `{self.lastDonationID}`')
+            return await ctx.send(content=f'Last donation id is `{self.poller.lastDonationID}`')
 
-        self.lastDonationID = string
+        self.poller.lastDonationID = string
         return await ctx.send(content=f'Last donation id set to `{string}`')
 
+    @commands.command(name='elpoll')
+    @commands.check_any(commands.is_owner(), commands.has_guild_permissions(administrator=True))
+    async def donation_polling(self, ctx, mode: Optional[str] = None):
+        if mode is not None:
+            if mode not in ['live', 'auto']:
+                return await ctx.send(f'{config.redTick} Polling mode must be `live` or `auto`')
+
+            self.poller.set_live(mode == 'live')
+            self.donation_check.change_interval(seconds=self.poller.interval)  # pylint: disable=no-member
+
+        mode = 'live' if self.poller.live else 'auto'
+        return await ctx.send(f'Donation polling is in `{mode}` mode, checking every {self.poller.interval} seconds')
+
     @commands.group(name='elperks', invoke_without_command=False)
     async def _perks(self, ctx):
         pass
@@ -70,14 +176,8 @@ class ExtraLife(commands.Cog):
     @_perks.command(name='grant')
     @commands.check_any(commands.is_owner(), commands.has_guild_permissions(view_audit_log=True))
     async def perks_grant(self, ctx, members: commands.Greedy[tools.ResolveUser]):
-        errors = 0
         msg = await ctx.send(f'{config.loading} Granting Extra Life perks to {len(members)} member(s)...')
-        for member in members:
-            try:
-                await self._assign_properties(member)
-
-            except ValueError:
-                errors += 1
+        errors = await self._assign_properties(members)
 
         if errors == len(members):
             return await msg.edit(content=f'{config.redTick} Extra Life perks granted to 0 members')
@@ -90,14 +190,8 @@ class ExtraLife(commands.Cog):
     @_perks.command(name='revoke')
     @commands.check_any(commands.is_owner(), commands.has_guild_permissions(view_audit_log=True))
     async def perks_revoke(self, ctx, members: commands.Greedy[tools.ResolveUser]):
-        errors = 0
         msg = await ctx.send(f'{config.loading} Revoking Extra Life perks to {len(members)} member(s)...')
-        for member in members:
-            try:
-                await self._remove_properties(member)
-
-            except ValueError:
-                errors += 1
+        errors = await self._remove_properties(members)
 
         if errors == len(members):
             return await msg.edit(content=f'{config.redTick} Extra Life perks revoked from 0 members')
@@ -107,8 +201,7 @@ class ExtraLife(commands.Cog):
                 content=f'{config.greenTick} Extra Life perks revoked from {len(members) - errors}/{len(members)} member(s).'
             )
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
+    async def process_message(self, message, parsed):
         if message.author.bot:
             return
         if message.channel.id != self.CHAT_CHANNEL:
@@ -118,37 +211,27 @@ class ExtraLife(commands.Cog):
 
         await message.author.add_roles(self.chatRole)
 
-    @tasks.loop(seconds=30)
+    @tasks.loop(seconds=DonationPoller.MIN_INTERVAL)
     async def donation_check(self):
-        donations_request = requests.get(self.DONATIONS_URL, timeout=8.0)
-
         try:
-            donations_request.raise_for_status()
-        except Exception as e:
-            logging.error(e)
+            donations = await self.poller.poll()
 
-        donations = donations_request.json()
-        donation_embeds = []
-
-        for donation in donations:
-            if donation['donationID'] == self.lastDonationID:
-                break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f'[ExtraLife] Unable to fetch donations: {e}')
+            return
 
-            # If we have no saved donation, assume we're upto date
-            if self.lastDonationID is None:
-                break
+        finally:
+            self.donation_check.change_interval(seconds=self.poller.interval)  # pylint: disable=no-member
 
+        for donation in donations:
             donor_name = 'Anonymous' if not 'displayName' in donation else donation['displayName']
             match = re.match(r'[\s\S]+#\d{4}|[a-z0-9._]+', donor_name)
             if match:
                 # Donor name format matches a Discord username
-                member = discord.utils.find(lambda m: str(m) == match.group(0), self.guild.members)
+                member = await self._find_member(match.group(0))
                 if member:
                     if self.donorRole not in member.roles:
-                        try:
-                            await self._assign_properties(member)
-
-                        except ValueError:
+                        if await self._assign_properties([member]):
                             await self.extra_life_admin.send(
                                 f':warning: An error occured while attempting to grant donation benefits to `{donor_name}`, they already have the background or trophy'
                             )
@@ -175,30 +258,58 @@ class ExtraLife(commands.Cog):
                 embed.add_field(name="Incentive claimed", value=self.INCENTIVES[donation['incentiveID']])
 
             embed.add_field(name="\uFEFF", value=self.FOOTER_LINKS, inline=False)  # ZERO WIDTH NO-BREAK SPACE (U+FEFF)
-            donation_embeds.append(embed)
             logging.info(f'Sending donation {donation["donationID"]} from {donor_name}')
 
-        donation_embeds.reverse()
-        for embed in donation_embeds:
             await self.extra_life_admin.send(embed=embed)
             await self.extra_life.send(embed=embed)
             await self.general.send(embed=embed)
             await self.donations.send(embed=embed)
 
-        self.lastDonationID = donations[0]['donationID']
+    async def _find_member(self, name: str) -> Optional[discord.Member]:
+        if self.guild.chunked:
+            # The index is normalised and includes past usernames, so confirm an exact match on the current name
+            candidates = map(self.guild.get_member, self.bot.names.find(name, usernames_only=True))
+            return discord.utils.find(lambda m: m and str(m) == name, candidates)
+
+        # Lazy member mode, ask the gateway for members with a matching username instead of scanning the cache
+        candidates = await self.guild.query_members(query=name.split('#')[0], limit=100)
+        return discord.utils.find(lambda m: str(m) == name, candidates)
+
+    async def _assign_properties(self, members: List[discord.Member]) -> int:
+        '''
+        Grants the donor role, trophy and background. The background is only granted along with the trophy. Returns the
+        number of members who already had either
+        '''
+        for member in members:
+            await member.add_roles(self.donorRole)
+
+        trophy = await tools.commit_profile_change_bulk(self.bot, members, 'trophy', self.TROPHY)
+        if not trophy.changed:
+            return len(members)
+
+        background = await tools.commit_profile_change_bulk(self.bot, trophy.changed, 'background', self.BACKGROUND)
+        return len(members) - len(background.changed)
+
+    async def _remove_properties(self, members: List[discord.Member]) -> int:
+        '''
+        Revokes the donor role, trophy and background. The background is only revoked along with the trophy. Returns
+        the number of members who did not have either
+        '''
+        for member in members:
+            await member.remove_roles(self.donorRole)
 
-    async def _assign_properties(self, member: discord.Member):
-        await member.add_roles(self.donorRole)
-        await tools.commit_profile_change(self.bot, member, 'trophy', self.TROPHY)
-        await tools.commit_profile_change(self.bot, member, 'background', self.BACKGROUND)
+        trophy = await tools.commit_profile_change_bulk(self.bot, members, 'trophy', self.TROPHY, revoke=True)
+        if not trophy.changed:
+            return len(members)
 
-    async def _remove_properties(self, member: discord.Member):
-        await member.remove_roles(self.donorRole)
-        await tools.commit_profile_change(self.bot, member, 'trophy', self.TROPHY, revoke=True)
-        await tools.commit_profile_change(self.bot, member, 'background', self.BACKGROUND, revoke=True)
+        background = await tools.commit_profile_change_bulk(
+            self.bot, trophy.changed, 'background', self.BACKGROUND, revoke=True
+        )
+        return len(members) - len(background.changed)
 
     def cog_unload(self):
         self.donation_check.cancel()  # pylint: disable=no-member
+        self.bot.pipeline.unregister('ExtraLife')
 
 
 async def setup(bot):
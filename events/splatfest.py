@@ -1,5 +1,6 @@
 import asyncio
 import collections
+import functools
 import logging
 import re
 
@@ -8,9 +9,15 @@ import discord
 from discord.ext import commands
 
 
+@functools.lru_cache(maxsize=16)
+def emote_regex(emote):
+    return re.compile(f'({emote})+', re.I)
+
+
 class Splatfest(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.bot.pipeline.register('Splatfest', self.process_message, priority=30)
         self.ACTIVE = False
         self.team1 = None
         self.team2 = None
@@ -194,15 +201,17 @@ class Splatfest(commands.Cog):
         self.team3 = None
         await ctx.send(f'{config.greenTick} Splatfest ended!')
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
+    def cog_unload(self):
+        self.bot.pipeline.unregister('Splatfest')
+
+    async def process_message(self, message, parsed):
         if self.ACTIVE and message.channel.id in [config.commandsChannel, self.channel]:
-            team1Emote = re.compile(f'({self.team1["emote"]})+', re.I)
+            team1Emote = emote_regex(self.team1['emote'])
             team1Role = message.guild.get_role(self.team1['role'])
-            team2Emote = re.compile(f'({self.team2["emote"]})+', re.I)
+            team2Emote = emote_regex(self.team2['emote'])
             team2Role = message.guild.get_role(self.team2['role'])
             if self.team3:
-                team3Emote = re.compile(f'({self.team3["emote"]})+', re.I)
+                team3Emote = emote_regex(self.team3['emote'])
                 team3Role = message.guild.get_role(self.team3['role'])
             else:
                 team3Emote = None
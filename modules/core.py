@@ -1,5 +1,6 @@
 import asyncio
 import collections
+import copy
 import logging
 import time
 import typing
@@ -21,6 +22,22 @@ class MainEvents(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+        # Join/leave events are micro-batched so a raid results in a handful of bulk writes and log posts
+        self.MEMBER_BATCH_WINDOW = 2  # Seconds to collect events before flushing
+        self.MEMBER_SUMMARY_THRESHOLD = 10  # Batches of this size or larger are logged as a single summary
+        self.MEMBER_RESTORE_CONCURRENCY = 10
+
+        self.pendingMemberEvents = []
+        self.memberFlushTask = None
+        self.restoreSemaphore = asyncio.Semaphore(self.MEMBER_RESTORE_CONCURRENCY)
+
+        self.messageCounter = tools.MessageCounter()
+        self.counterBackfill = None
+        self.backfillSemaphore = asyncio.Semaphore(4)  # Channels crawled concurrently by !update servermsgcache
+
+        # Message content is end user data, it lives in its own collection and is expired by a TTL index
+        self.EUD_RETENTION = 60 * 60 * 24 * 365  # Store message content up to 1 year old
+
     async def cog_load(self):
         try:
             await self.bot.load_extension('tools')
@@ -37,7 +54,22 @@ class MainEvents(commands.Cog):
         except discord.ext.commands.errors.ExtensionAlreadyLoaded:
             pass
 
-        # self.sanitize_eud.start()  # pylint: disable=no-member
+        msgDB = mclient.bowser.messages
+        msgDB.create_index([('timestamp', pymongo.ASCENDING)])
+        msgDB.create_index([('author', pymongo.ASCENDING), ('timestamp', pymongo.DESCENDING)])
+        msgDB.create_index([('channel', pymongo.ASCENDING), ('timestamp', pymongo.DESCENDING)])
+        mclient.bowser.messageContent.create_index('date', expireAfterSeconds=self.EUD_RETENTION)
+        mclient.modmail.logChunks.create_index([('archive', pymongo.ASCENDING), ('index', pymongo.ASCENDING)])
+        mclient.modmail.logChunks.create_index('archived_message_ids')
+
+        if not mclient.bowser.messageCounts.find_one({}, projection={'_id': 1}) and msgDB.find_one(
+            {}, projection={'_id': 1}
+        ):
+            # First start since message counters were introduced, build them from message history
+            self.counterBackfill = asyncio.create_task(self._backfill_message_counts())
+
+        self.flush_message_counts.start()  # pylint: disable=no-member
+        self.bot.pipeline.register('MainEvents', self.process_message, priority=0)
 
         self.serverLogs = self.bot.get_channel(config.logChannel)
         self.modLogs = self.bot.get_channel(config.modChannel)
@@ -59,22 +91,58 @@ class MainEvents(commands.Cog):
                 }
             )
 
-    #    def cog_unload(self):
-    #        self.sanitize_eud.cancel()  # pylint: disable=no-member
-
-    @tasks.loop(hours=24)
-    async def sanitize_eud(self):
-        logging.info('[Core] Starting sanitzation of old EUD')
+    async def cog_unload(self):
+        self.bot.pipeline.unregister('MainEvents')
+        self.flush_message_counts.cancel()  # pylint: disable=no-member
+        self.messageCounter.flush()
+
+    @tasks.loop(seconds=15)
+    async def flush_message_counts(self):
+        self.messageCounter.flush()
+        self.bot.messageCache.flush()  # Spilled messages still waiting to be committed while the cache is idle
+
+    def _migrate_message_content(self) -> int:
+        '''
+        Moves content stored inline on bowser.messages by older versions into the TTL'd content collection. Blocking,
+        run it in a worker thread. Returns the number of messages whose content was kept
+        '''
         msgDB = mclient.bowser.messages
-        msgDB.update_many(
-            {
-                'timestamp': {"$lte": time.time() - (86400 * 365)},
-                'sanitized': False,
-            },  # Store message data upto 1 year old
-            {"$set": {'content': None, 'sanitized': True}},
-        )
+        contentDB = mclient.bowser.messageContent
+        cutoff = time.time() - self.EUD_RETENTION
+        migrated = 0
+        operations = []
+        for doc in msgDB.find({'content': {'$exists': True}}, projection={'content': 1, 'timestamp': 1}):
+            if doc['content'] and doc['timestamp'] > cutoff:
+                operations.append(
+                    pymongo.UpdateOne(
+                        {'_id': doc['_id']},
+                        {
+                            '$setOnInsert': {
+                                'content': doc['content'],
+                                'date': datetime.fromtimestamp(doc['timestamp'], tz=timezone.utc),
+                            }
+                        },
+                        upsert=True,
+                    )
+                )
+                migrated += 1
+
+            if len(operations) >= 1000:
+                contentDB.bulk_write(operations, ordered=False)
+                operations = []
+
+        if operations:
+            contentDB.bulk_write(operations, ordered=False)
 
-        logging.info('[Core] Finished sanitzation of old EUD')
+        msgDB.update_many({'content': {'$exists': True}}, {'$unset': {'content': '', 'sanitized': ''}})
+        return migrated
+
+    async def _backfill_message_counts(self) -> int:
+        logging.info('[Core] Rebuilding message counters from message history')
+        self.messageCounter.flush()
+        users = await asyncio.to_thread(tools.MessageCounter.backfill)
+        logging.info(f'[Core] Rebuilt message counters for {users} users')
+        return users
 
     @commands.command(name='ping')
     async def _ping(self, ctx):
@@ -138,33 +206,143 @@ class MainEvents(commands.Cog):
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
-        db = mclient.bowser.users
-        doc = db.find_one({'_id': member.id})
-        roleList = []
-        restored = False
+        self._queue_member_event('join', member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        self._queue_member_event('leave', member)
 
-        if not doc:
-            await tools.store_user(member)
-            doc = db.find_one({'_id': member.id})
+    def _queue_member_event(self, event, member):
+        self.pendingMemberEvents.append((event, member, int(datetime.now(tz=timezone.utc).timestamp())))
+        if not self.memberFlushTask or self.memberFlushTask.done():
+            self.memberFlushTask = asyncio.create_task(self._flush_member_events())
 
-        else:
-            db.update_one(
-                {'_id': member.id},
-                {'$push': {'joins': int(datetime.now(tz=timezone.utc).timestamp())}},
-            )
+    async def _flush_member_events(self):
+        await asyncio.sleep(self.MEMBER_BATCH_WINDOW)
+        events = self.pendingMemberEvents
+        self.pendingMemberEvents = []
 
-        new = (
-            ':new: ' if (datetime.now(tz=timezone.utc) - member.created_at).total_seconds() <= 60 * 60 * 24 * 14 else ''
-        )  # Two weeks
+        try:
+            # Write every user record and join/leave timestamp in the batch with a single bulk write
+            db = mclient.bowser.users
+            userIds = list({member.id for _, member, _ in events})
+            docs = {doc['_id']: doc for doc in db.find({'_id': {'$in': userIds}})}
+            operations = []
+            inserts = {}  # Operation index: (user id, join timestamp) of new user documents
+            joins = []
+            leaves = []
+            for event, member, timestamp in events:
+                if event == 'join':
+                    if member.id not in docs:
+                        docs[member.id] = tools.new_user_doc(member, timestamp)
+                        inserts[len(operations)] = (member.id, timestamp)
+                        operations.append(pymongo.InsertOne(docs[member.id]))
 
-        embed = discord.Embed(color=0x417505, timestamp=datetime.now(tz=timezone.utc))
-        embed.set_author(name=f'{member} ({member.id})', icon_url=member.display_avatar.url)
-        created_at = f'{new} <t:{int(member.created_at.timestamp())}:f>'
-        created_at += '' if not new else f'\n<t:{int(member.created_at.timestamp())}:R>'
-        embed.add_field(name='Created at', value=created_at)
-        embed.add_field(name='Mention', value=f'<@{member.id}>')
+                    else:
+                        operations.append(pymongo.UpdateOne({'_id': member.id}, {'$push': {'joins': timestamp}}))
 
-        await self.serverLogs.send(':inbox_tray: User joined', embed=embed)
+                    joins.append((member, docs[member.id]))
+
+                else:
+                    operations.append(pymongo.UpdateOne({'_id': member.id}, {'$push': {'leaves': timestamp}}))
+                    leaves.append(member)
+
+            if operations:
+                try:
+                    # Unordered so one duplicate insert, such as from a racing store_user, does not drop the rest
+                    db.bulk_write(operations, ordered=False)
+
+                except pymongo.errors.BulkWriteError as e:
+                    errors = e.details['writeErrors']
+                    logging.error(f'[Core] Member event bulk write had {len(errors)} failed writes')
+                    for error in errors:
+                        if error['code'] == 11000 and error['index'] in inserts:
+                            # The user was stored by something else meanwhile, record the join on that document
+                            userId, timestamp = inserts[error['index']]
+                            db.update_one({'_id': userId}, {'$push': {'joins': timestamp}})
+
+            if joins:
+                summarize = len(joins) >= self.MEMBER_SUMMARY_THRESHOLD
+                if summarize:
+                    try:
+                        await self._send_member_summary(':inbox_tray: {} users joined', 0x417505, [x[0] for x in joins])
+
+                    except discord.HTTPException as e:
+                        logging.error(f'[Core] Failed to send member join summary: {e}')
+
+                results = await asyncio.gather(
+                    *(self._process_join(member, doc, summarize) for member, doc in joins), return_exceptions=True
+                )
+                for result in results:
+                    if isinstance(result, Exception):
+                        logging.error(f'[Core] Failed to process member join: {result}', exc_info=result)
+
+            if leaves:
+                summarize = len(leaves) >= self.MEMBER_SUMMARY_THRESHOLD
+                if summarize:
+                    try:
+                        await self._send_member_summary(':outbox_tray: {} users left', 0x8B572A, leaves)
+
+                    except discord.HTTPException as e:
+                        logging.error(f'[Core] Failed to send member leave summary: {e}')
+
+                for member in leaves:
+                    try:
+                        await self._process_leave(member, summarize)
+
+                    except Exception as e:
+                        logging.error(f'[Core] Failed to process member leave: {e}', exc_info=e)
+
+        except Exception:
+            logging.exception(f'[Core] Failed to flush a batch of {len(events)} member join/leave events')
+
+        finally:
+            if self.pendingMemberEvents:  # Events that arrived while we were flushing
+                self.memberFlushTask = asyncio.create_task(self._flush_member_events())
+
+    async def _send_member_summary(self, title, color, members):
+        lines = []
+        newCount = 0
+        for member in members:
+            new = (datetime.now(tz=timezone.utc) - member.created_at).total_seconds() <= 60 * 60 * 24 * 14  # Two weeks
+            newCount += new
+            lines.append(f'{":new: " if new else ""}{member} ({member.id})')
+
+        description = ''
+        for index, line in enumerate(lines):
+            if len(description) + len(line) > 3900:  # Embed descriptions are limited to 4096 characters
+                description += f'...and {len(lines) - index} more'
+                break
+
+            description += line + '\n'
+
+        embed = discord.Embed(description=description, color=color, timestamp=datetime.now(tz=timezone.utc))
+        embed.add_field(name='New accounts', value=str(newCount))
+        await self.serverLogs.send(title.format(len(members)), embed=embed)
+
+    async def _process_join(self, member, doc, summarize=False):
+        async with self.restoreSemaphore:
+            await self._restore_member(member, doc, summarize)
+
+    async def _restore_member(self, member, doc, summarize=False):
+        db = mclient.bowser.users
+        roleList = []
+
+        if not summarize:
+            new = (
+                ':new: '
+                if (datetime.now(tz=timezone.utc) - member.created_at).total_seconds() <= 60 * 60 * 24 * 14
+                else ''
+            )  # Two weeks
+
+            embed = discord.Embed(color=0x417505, timestamp=datetime.now(tz=timezone.utc))
+            embed.set_author(name=f'{member} ({member.id})', icon_url=member.display_avatar.url)
+            created_at = f'{new} <t:{int(member.created_at.timestamp())}:f>'
+            created_at += '' if not new else f'\n<t:{int(member.created_at.timestamp())}:R>'
+            embed.add_field(name='Created at', value=created_at)
+            embed.add_field(name='Mention', value=f'<@{member.id}>')
+
+            await self.serverLogs.send(':inbox_tray: User joined', embed=embed)
 
         needsRestore = False
         hierarchyFails = []
@@ -187,45 +365,44 @@ class MainEvents(commands.Cog):
             await member.edit(roles=roleList, reason='Automatic role restore action')
 
         punDB = mclient.bowser.puns
-        if needsRestore or punDB.find_one({'user': member.id, 'type': 'mute', 'active': True}):
+        sanctions = self.bot.sanctions
+        if needsRestore or sanctions.has(member.id, 'mute'):
             punTypes = {
                 'mute': 'Mute',
                 'blacklist': 'Channel Blacklist ({})',
             }
-            puns = punDB.find({'user': member.id, 'active': True})
             restoredPuns = []
-            if puns.count():
-                for x in puns:
-                    if x['type'] == 'blacklist':
-                        restoredPuns.append(punTypes[x['type']].format(x['context']))
-
-                    elif x['type'] in ['strike', 'kick', 'ban', 'appealdeny']:
-                        continue  # These are not punishments being "restored", instead only status is being tracked
-
-                    elif x['type'] == 'mute':
-                        if (
-                            x['expiry'] < time.time()
-                        ):  # If the member is rejoining after mute has expired, the task has already quit. Restart it
-                            mod = self.bot.get_cog('Moderation Commands')
-                            await mod.expire_actions(x['_id'], member.guild.id)
-
-                        else:
-                            # The member rejoined while a mute is still active, reapply the chat timeout.
-                            # We want to make sure if the expiry was modified while they were not in the
-                            # server that the correct timeout is applied
-                            await member.edit(
-                                timed_out_until=datetime.fromtimestamp(x['expiry'], tz=timezone.utc),
-                                reason='Reapplying timeout after user rejoined',
-                            )
-
-                            restoredPuns.append(punTypes[x['type']])
-
-                    elif x['type'] in ['tier1', 'tier2', 'tier3']:
-                        # We don't want to handle this, these will be converted to strikes further on
-                        pass
+            for x in sanctions.get(member.id):
+                if x.type == 'blacklist':
+                    restoredPuns.append(punTypes[x.type].format(x.context))
+
+                elif x.type in ['strike', 'kick', 'ban', 'appealdeny']:
+                    continue  # These are not punishments being "restored", instead only status is being tracked
+
+                elif x.type == 'mute':
+                    if (
+                        x.expiry < time.time()
+                    ):  # If the member is rejoining after mute has expired, the task has already quit. Restart it
+                        mod = self.bot.get_cog('Moderation Commands')
+                        await mod.expire_actions(x.id, member.guild.id)
 
                     else:
-                        restoredPuns.append(punTypes[x['type']])
+                        # The member rejoined while a mute is still active, reapply the chat timeout.
+                        # We want to make sure if the expiry was modified while they were not in the
+                        # server that the correct timeout is applied
+                        await member.edit(
+                            timed_out_until=datetime.fromtimestamp(x.expiry, tz=timezone.utc),
+                            reason='Reapplying timeout after user rejoined',
+                        )
+
+                        restoredPuns.append(punTypes[x.type])
+
+                elif x.type in ['tier1', 'tier2', 'tier3']:
+                    # We don't want to handle this, these will be converted to strikes further on
+                    pass
+
+                else:
+                    restoredPuns.append(punTypes[x.type])
 
             embed = discord.Embed(color=0x4A90E2, timestamp=datetime.now(tz=timezone.utc))
             embed.set_author(name=f'{member} ({member.id})', icon_url=member.display_avatar.url)
@@ -244,20 +421,19 @@ class MainEvents(commands.Cog):
             embed.add_field(name='Mention', value=f'<@{member.id}>')
             await self.serverLogs.send(':shield: Member restored', embed=embed)
 
-        if punDB.count_documents({'user': member.id, 'active': True, 'type': {'$in': ['mute', 'strike', 'blacklist']}}):
+        activePuns = sanctions.get(member.id, ['mute', 'strike', 'blacklist'])
+        if activePuns:
             activeHist = []
             strikes = 0
-            for pun in punDB.find(
-                {'user': member.id, 'active': True, 'type': {'$in': ['mute', 'strike', 'blacklist']}}
-            ):
-                if pun['type'] == 'strike':
-                    strikes += pun['active_strike_count']
+            for pun in activePuns:
+                if pun.type == 'strike':
+                    strikes += pun.strikes
 
-                elif pun['type'] == 'mute':
+                elif pun.type == 'mute':
                     activeHist.append('Mute')
 
-                elif pun['type'] == 'blacklist':
-                    activeHist.append(f'Blacklist ({pun["context"]})')
+                elif pun.type == 'blacklist':
+                    activeHist.append(f'Blacklist ({pun.context})')
 
             if strikes:
                 activeHist.append(f'{strikes} Strike{"s" if strikes > 1 else ""}')
@@ -314,19 +490,13 @@ class MainEvents(commands.Cog):
                     {'_id': member.id},
                     {'$set': {'migrate_unnotified': False, 'strike_check': time.time() + (60 * 60 * 24 * 7)}},
                 )  # Setting the next expiry check time
+                sanctions.refresh(member.id)
                 mod = self.bot.get_cog('Moderation Commands')
                 await mod.expire_actions(docID, member.guild.id)
 
-    @commands.Cog.listener()
-    async def on_member_remove(self, member):
-        db = mclient.bowser.puns
-        puns = db.find({'user': member.id, 'active': True, 'type': {'$in': ['strike', 'mute', 'blacklist']}})
-
-        mclient.bowser.users.update_one(
-            {'_id': member.id},
-            {'$push': {'leaves': int(datetime.now(tz=timezone.utc).timestamp())}},
-        )
-        if puns.count():
+    async def _process_leave(self, member, summarize=False):
+        puns = self.bot.sanctions.get(member.id, ['strike', 'mute', 'blacklist'])
+        if puns:
             embed = discord.Embed(
                 description=f'{member} ({member.id}) left the server\n\n:warning: __**User had active punishments**__ :warning:',
                 color=0xD62E44,
@@ -334,7 +504,7 @@ class MainEvents(commands.Cog):
             )
             punishments = []
             for x in puns:
-                punishments.append(config.punStrs[x['type']])
+                punishments.append(config.punStrs[x.type])
 
             punComma = ', '.join(punishments)
             embed.add_field(name='Punishment types', value=punComma)
@@ -344,6 +514,9 @@ class MainEvents(commands.Cog):
                 f':warning: **{member}** ({member.id}) left the server with active punishments. See logs for more details\n```{punCode}```'
             )
 
+        elif summarize:
+            return  # Already included in the batch summary
+
         else:
             embed = discord.Embed(color=0x8B572A, timestamp=datetime.now(tz=timezone.utc))
 
@@ -352,27 +525,49 @@ class MainEvents(commands.Cog):
         await self.serverLogs.send(':outbox_tray: User left', embed=embed)
 
     @commands.Cog.listener()
-    async def on_member_ban(self, guild: discord.Guild, user: discord.User):
-        if guild.id != config.nintendoswitch:
+    async def on_audit_log_entry_create(self, entry: discord.AuditLogEntry):
+        if entry.guild.id != config.nintendoswitch:
             return
 
+        if entry.action == discord.AuditLogAction.ban:
+            action = 'ban'
+
+        elif entry.action == discord.AuditLogAction.unban:
+            action = 'unban'
+
+        else:
+            return
+
+        userid = entry.target.id
+        if entry.user_id == self.bot.user.id:
+            return  # Issued by us, the pun record is written by the command
+
+        if action == 'unban' and entry.user_id == config.parakarry:
+            return  # Parakarry generates it's own pun records, exit
+
         db = mclient.bowser.puns
-        await asyncio.sleep(10)  # Wait 10 seconds to allow audit log to update
-        if not db.find_one({'user': user.id, 'type': 'ban', 'active': True, 'timestamp': {'$gt': time.time() - 60}}):
-            # Manual ban
-            audited = None
-            async for entry in guild.audit_logs(action=discord.AuditLogAction.ban):
-                if entry.target == user:
-                    audited = entry
-                    break
-
-            if audited:
-                reason = audited.reason or '-No reason specified-'
-                docID = await tools.issue_pun(audited.target.id, audited.user.id, 'ban', reason)
-
-                await tools.send_modlog(
-                    self.bot, self.modLogs, 'ban', docID, reason, user=user, moderator=audited.user, public=True
-                )
+        if db.find_one({'user': userid, 'type': action, 'timestamp': {'$gt': time.time() - 60}}):
+            return  # Recorded by another integration sharing the database
+
+        user = await self.bot.resolver.fetch(userid)
+        moderator = entry.user or await self.bot.resolver.fetch(entry.user_id)
+        reason = entry.reason or '-No reason specified-'
+        if action == 'ban':
+            docID = await tools.issue_pun(userid, moderator.id, 'ban', reason)
+
+        else:
+            docID = await tools.issue_pun(userid, moderator.id, 'unban', reason, active=False)
+            db.update_one({'user': userid, 'type': 'ban', 'active': True}, {'$set': {'active': False}})
+
+        self.bot.sanctions.refresh(userid)
+        await tools.send_modlog(
+            self.bot, self.modLogs, action, docID, reason, user=user, moderator=moderator, public=True
+        )
+
+    @commands.Cog.listener()
+    async def on_member_ban(self, guild: discord.Guild, user: discord.User):
+        if guild.id != config.nintendoswitch:
+            return
 
         embed = discord.Embed(color=discord.Color(0xD0021B), timestamp=datetime.now(tz=timezone.utc))
         embed.set_author(name=f'{user} ({user.id})', icon_url=user.display_avatar.url)
@@ -385,28 +580,6 @@ class MainEvents(commands.Cog):
         if guild.id != config.nintendoswitch:
             return
 
-        db = mclient.bowser.puns
-        if not db.find_one({'user': user.id, 'type': 'unban', 'timestamp': {'$gt': time.time() - 60}}):
-            # Manual unban
-
-            audited = None
-            async for entry in guild.audit_logs(action=discord.AuditLogAction.unban):
-                if entry.target == user:
-                    audited = entry
-                    break
-
-            if audited:
-                if audited.user.id == config.parakarry:
-                    return  # Parakarry generates it's own pun records, exit
-
-                reason = audited.reason or '-No reason specified-'
-                docID = await tools.issue_pun(audited.target.id, audited.user.id, 'unban', reason, active=False)
-                db.update_one({'user': audited.target.id, 'type': 'ban', 'active': True}, {'$set': {'active': False}})
-
-                await tools.send_modlog(
-                    self.bot, self.modLogs, 'unban', docID, reason, user=user, moderator=audited.user, public=True
-                )
-
         embed = discord.Embed(color=discord.Color(0x88FF00), timestamp=datetime.now(tz=timezone.utc))
         embed.set_author(name=f'{user} ({user.id})', icon_url=user.display_avatar.url)
         embed.add_field(name='Mention', value=f'<@{user.id}>')
@@ -420,8 +593,7 @@ class MainEvents(commands.Cog):
             # We only want to send an API call if we aren't already in it
             await thread.join()
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
+    async def process_message(self, message, parsed):
         if message.author.bot or message.webhook_id:
             return
 
@@ -441,15 +613,18 @@ class MainEvents(commands.Cog):
             'guild': message.guild.id,
             'channel': message.channel.id,
             'parent_channel': None,
-            'content': message.content,
             'timestamp': timestamp,
-            'sanitized': False,
         }
 
         if issubclass(message.channel.__class__, discord.Thread):
             obj['parent_channel'] = message.channel.parent_id
 
         db.insert_one(obj)
+        mclient.bowser.messageContent.insert_one(
+            {'_id': message.id, 'content': message.content, 'date': message.created_at}
+        )
+        self.messageCounter.increment(message.author.id, message.channel.id, timestamp)
+        self.bot.messageCache.add(message)
 
         await self.bot.process_commands(message)  # Allow commands to fire
         return
@@ -460,16 +635,10 @@ class MainEvents(commands.Cog):
             logging.debug(f'Discarding non guild bulk delete {messages[0].channel.type}  {messages[0].id}')
             return
 
-        await asyncio.sleep(10)  # Give chance for clean command to finish and discord to process delete
-        db = mclient.bowser.archive
-        checkStamp = int(
-            time.time() - 600
-        )  # Rate limiting, instability, and being just slow to fire are other factors that could delay the event
-        archives = db.find({'timestamp': {'$gt': checkStamp}})
-        if archives:  # If the bulk delete is the result of us, exit
-            for x in archives:
-                if messages[0].id in x['messages']:
-                    return
+        # If the bulk delete is the result of us, the clean command archives it instead. Purged IDs are recorded
+        # in memory as they are selected, with the indexed archive chunks as a fallback across restarts
+        if messages[0].id in self.bot.purgedMessages or tools.is_archived(messages[0].id):
+            return
 
         archiveID = await tools.message_archive(messages)
 
@@ -480,8 +649,27 @@ class MainEvents(commands.Cog):
         )
         return await self.serverLogs.send(':printer: New message archive generated', embed=embed)
 
+    def _stored_content(self, message_id: int, dbMessage: typing.Optional[dict] = None) -> typing.Optional[str]:
+        '''
+        Returns saved content for a message from the content collection, falling back to content stored inline on
+        bowser.messages by older versions until !update msgcontent has moved it
+        '''
+        dbContent = mclient.bowser.messageContent.find_one({'_id': message_id})
+        if dbContent:
+            return dbContent['content']
+
+        if dbMessage is None:
+            dbMessage = mclient.bowser.messages.find_one({'_id': message_id}, projection={'content': 1, 'timestamp': 1})
+
+        if dbMessage and dbMessage.get('content') and dbMessage['timestamp'] > time.time() - self.EUD_RETENTION:
+            return dbMessage['content']
+
+        return None
+
     @commands.Cog.listener()
     async def on_raw_message_delete(self, payload):
+        cached = self.bot.messageCache.pop(payload.message_id)
+        attachments = []
         if payload.cached_message:
             if (
                 payload.cached_message.type not in [discord.MessageType.default, discord.MessageType.reply]
@@ -499,6 +687,17 @@ class MainEvents(commands.Cog):
             user = payload.cached_message.author
             jump_url = payload.cached_message.jump_url
             content = payload.cached_message.content if payload.cached_message.content else '-No message content-'
+            attachments = [x.proxy_url for x in payload.cached_message.attachments]
+
+        elif cached:
+            # Only ingested messages are kept by the compact cache, so no type checks are needed
+            if not cached.content and not cached.attachments:
+                return  # Blank or null content (could be embed)
+
+            user = await self.bot.resolver.fetch(cached.author)
+            jump_url = cached.jump_url
+            content = cached.content if cached.content else '-No message content-'
+            attachments = list(cached.attachments)
 
         else:
             # Message is not in ram cache, pull from DB or ignore if missing
@@ -510,10 +709,10 @@ class MainEvents(commands.Cog):
                 )
                 return
 
-            user = await self.bot.fetch_user(dbMessage['author'])
+            user = await self.bot.resolver.fetch(dbMessage['author'])
             jump_url = f'https://discord.com/channels/{dbMessage["guild"]}/{dbMessage["channel"]}/{dbMessage["_id"]}'
             content = (
-                '-No saved copy of message content is available-' if not dbMessage['content'] else dbMessage['content']
+                self._stored_content(payload.message_id, dbMessage) or '-No saved copy of message content is available-'
             )
 
         embed = discord.Embed(
@@ -523,12 +722,11 @@ class MainEvents(commands.Cog):
         )
         embed.set_author(name=f'{str(user)} ({user.id})', icon_url=user.display_avatar.url)
         embed.add_field(name='Mention', value=f'<@{user.id}>')
-        if payload.cached_message and len(payload.cached_message.attachments) == 1:
-            embed.set_image(url=payload.cached_message.attachments[0].proxy_url)
+        if len(attachments) == 1:
+            embed.set_image(url=attachments[0])
 
-        elif payload.cached_message and len(payload.cached_message.attachments) > 1:
+        elif len(attachments) > 1:
             # More than one attachment, use fields
-            attachments = [x.proxy_url for x in payload.cached_message.attachments]
             for a in range(len(attachments)):
                 embed.add_field(name=f'Attachment {a + 1}', value=attachments[a])
 
@@ -538,6 +736,24 @@ class MainEvents(commands.Cog):
 
         await self.serverLogs.send(f':wastebasket: Message deleted in <#{payload.channel_id}>', embed=embed)
 
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload):
+        if payload.cached_message or not payload.guild_id:
+            return  # Edits of messages in the library cache are handled by on_message_edit
+
+        cached = self.bot.messageCache.get(payload.message_id)
+        if cached:
+            content = cached.content
+
+        else:
+            content = self._stored_content(payload.message_id)
+            if content is None:
+                return
+
+        before = copy.copy(payload.message)
+        before.content = content
+        await self.on_message_edit(before, payload.message)
+
     @commands.Cog.listener()
     async def on_message_edit(self, before, after):
         if not before.guild:
@@ -547,6 +763,9 @@ class MainEvents(commands.Cog):
         if before.content == after.content or before.author.bot:
             return
 
+        mclient.bowser.messageContent.update_one({'_id': after.id}, {'$set': {'content': after.content}})
+        self.bot.messageCache.update(after)
+
         if before.type not in [discord.MessageType.default, discord.MessageType.reply]:
             logging.debug(f'on_message_edit discarding non-normal-message: {before.type=}, {before.id=}')
             return  # No system messages
@@ -723,29 +942,49 @@ class MainEvents(commands.Cog):
 
             await self.bot.user.edit(username=username)
 
+        elif sub == 'msgcounts':
+            if self.counterBackfill and not self.counterBackfill.done():
+                return await ctx.send(f'{config.redTick} Message counters are already being rebuilt')
+
+            msg = await ctx.send(f'{config.loading} Rebuilding message counters from message history...')
+            self.counterBackfill = asyncio.create_task(self._backfill_message_counts())
+            users = await self.counterBackfill
+            return await msg.edit(content=f'{config.greenTick} Rebuilt message counters for {users} users')
+
+        elif sub == 'msgcontent':
+            msg = await ctx.send(f'{config.loading} Migrating stored message content...')
+            migrated = await asyncio.to_thread(self._migrate_message_content)
+            return await msg.edit(content=f'{config.greenTick} Migrated content for {migrated} messages')
+
         elif sub == 'servermsgcache':
+            # `!update servermsgcache gaps` only fetches messages sent after each channel's newest checkpoint
+            gaps = bool(args) and args[0] == 'gaps'
             funcStart = time.time()
-            logging.info('[Core] Starting db message sync')
-            await ctx.send(
-                'Starting syncronization of db for all messages in server. This will take a conciderable amount of time.'
+            logging.info(f'[Core] Starting db message sync{" (gaps)" if gaps else ""}')
+            channels = [x for x in ctx.guild.channels if issubclass(x.__class__, discord.abc.Messageable)]
+            status = await ctx.send(
+                f'{config.loading} Starting syncronization of db for messages in {len(channels)} channels. '
+                'Progress is checkpointed and will resume if interrupted.'
             )
-            for channel in ctx.guild.channels:
-                if not issubclass(channel.__class__, discord.abc.Messageable):
-                    continue
 
-                await ctx.send(f'Starting syncronization for <#{channel.id}>')
+            progress = {}
+            jobs = [asyncio.create_task(self.store_message_cache(x, gaps, progress)) for x in channels]
+            while not all(x.done() for x in jobs):
+                await asyncio.wait(jobs, timeout=30)
+                await status.edit(content=f'{config.loading} {self._backfill_status(progress, funcStart)}')
 
-                try:
-                    x, y = await self.store_message_cache(channel)
-                    await ctx.send(
-                        f'Syncronized <#{channel.id}>. Processed {x} messages and recorded meta data for {y} messages'
-                    )
+            failed = [channels[i] for i, x in enumerate(jobs) if x.cancelled() or x.exception()]
+            for i, x in enumerate(jobs):
+                if x.cancelled():
+                    logging.error(f'[Core] Syncronization of {channels[i].id} was cancelled')
 
-                except (discord.Forbidden, discord.HTTPException):
-                    await ctx.send(f'Failed to syncronize <#{channel.id}>')
+                elif x.exception():
+                    logging.error(f'[Core] Failed to syncronize {channels[i].id}: {x.exception()}')
 
+            await status.edit(content=f'{config.greenTick} {self._backfill_status(progress, funcStart)}')
             timeToComplete = tools.humanize_duration(tools.resolve_duration(f'{int(time.time() - funcStart)}s'))
-            return await ctx.send(f'<@{ctx.author.id}> Syncronization completed. Took {timeToComplete}')
+            failStr = '' if not failed else f'. Failed to syncronize {", ".join(x.mention for x in failed)}'
+            return await ctx.send(f'<@{ctx.author.id}> Syncronization completed. Took {timeToComplete}{failStr}')
 
         else:
             return await ctx.send('Invalid sub command')
@@ -758,38 +997,135 @@ class MainEvents(commands.Cog):
         date = datetime.strptime(strTime, '%m/%d/%y')
         expiry = None if not active else int(date.timestamp() + (60 * 60 * 24 * 30))
         await tools.issue_pun(int(user), int(moderator), _type, reason, expiry, active, 'old', date.timestamp())
+        self.bot.sanctions.refresh(int(user))
         await ctx.send(f'{config.greenTick} Done')
 
+    @commands.command(name='httpstats')
+    @commands.is_owner()
+    async def _httpstats(self, ctx):
+        metrics = self.bot.web.metrics
+        if not metrics:
+            return await ctx.send('No HTTP requests have been made yet')
+
+        lines = []
+        for host, stats in sorted(metrics.items(), key=lambda x: x[1]['requests'], reverse=True):
+            avg = stats['time'] / stats['requests'] * 1000 if stats['requests'] else 0
+            lines.append(
+                f'{host}: {stats["requests"]} requests, {stats["errors"]} errors, {stats["retries"]} retries, {avg:.0f}ms avg'
+            )
+
+        return await ctx.send('```\n' + '\n'.join(lines) + '\n```')
+
     @commands.command(name='shutdown')
     @commands.is_owner()
     async def _shutdown(self, ctx):
         await ctx.send('Closing connection to discord and shutting down')
         return await self.bot.close()
 
-    async def store_message_cache(self, channel):
-        # users = mclient.bowser.users
+    def _backfill_status(self, progress, funcStart):
+        processed = sum(x['processed'] for x in progress.values())
+        recorded = sum(x['recorded'] for x in progress.values())
+        completed = sum(x['fraction'] >= 1 for x in progress.values())
+        fraction = sum(x['fraction'] for x in progress.values()) / len(progress) if progress else 0
+        elapsed = time.time() - funcStart
+        status = (
+            f'Syncronized {completed}/{len(progress)} channels ({fraction:.1%}). '
+            f'Processed {processed} messages and recorded meta data for {recorded} messages'
+        )
+        if 0 < fraction < 1:
+            eta = tools.humanize_duration(tools.resolve_duration(f'{int(elapsed * (1 - fraction) / fraction) + 1}s'))
+            status += f'. Estimated time remaining: {eta}'
+
+        return status
+
+    async def store_message_cache(self, channel, gaps=False, progress=None):
+        '''
+        Backfills message metadata for a channel from its history. The crawl position is checkpointed in
+        bowser.backfill so an interrupted run resumes where it left off; with gaps=True only messages newer than the
+        last checkpoint are fetched. Channels are crawled concurrently, bounded by backfillSemaphore
+        '''
         db = mclient.bowser.messages
-        x = 0
-        y = 0
-        async for message in channel.history(limit=None):
-            x += 1
-            if message.author.bot:
-                continue
-
-            msg = db.find_one({'_id': message.id})
-            if not msg:
-                y += 1
-                db.insert_one(
-                    {
-                        '_id': message.id,
-                        'author': message.author.id,
-                        'guild': message.guild.id,
-                        'channel': message.channel.id,
-                        'timestamp': int(message.created_at.timestamp()),
-                    }
+        checkpoints = mclient.bowser.backfill
+        checkpoint = checkpoints.find_one({'_id': channel.id})
+        if not checkpoint:
+            checkpoint = {'_id': channel.id, 'oldest': None, 'newest': channel.last_message_id, 'complete': False}
+            checkpoints.insert_one(checkpoint)
+
+        if progress is None:
+            progress = {}
+
+        state = progress[channel.id] = {'processed': 0, 'recorded': 0, 'fraction': 0}
+        if gaps and not checkpoint['newest']:
+            gaps = False  # Never reached a message in this channel, there is no checkpoint to fill from
+
+        if gaps:
+            # Walk forward from the newest checkpoint to now
+            startTime = discord.utils.snowflake_time(checkpoint['newest'])
+            endTime = datetime.now(tz=timezone.utc)
+            history = channel.history(limit=None, after=discord.Object(checkpoint['newest']), oldest_first=True)
+
+        elif checkpoint['complete']:
+            state['fraction'] = 1
+            return state['processed'], state['recorded']
+
+        else:
+            # Walk backwards from where the previous run stopped, or the newest message, to the channel creation
+            startTime = channel.created_at
+            endTime = discord.utils.snowflake_time(checkpoint['oldest'] or checkpoint['newest'] or channel.id)
+            before = discord.Object(checkpoint['oldest']) if checkpoint['oldest'] else None
+            history = channel.history(limit=None, before=before)
+
+        span = (endTime - startTime).total_seconds() or 1
+
+        def write(batch, position):
+            if batch:
+                result = db.bulk_write(batch, ordered=False)
+                state['recorded'] += result.upserted_count
+
+            checkpoints.update_one(
+                {'_id': channel.id}, {'$set': {'newest' if gaps else 'oldest': position, 'updated': time.time()}}
+            )
+
+        async with self.backfillSemaphore:
+            batch = []
+            position = None
+            async for message in history:
+                state['processed'] += 1
+                position = message.id
+                created = message.created_at
+                state['fraction'] = ((created - startTime) if gaps else (endTime - created)).total_seconds() / span
+                if message.author.bot:
+                    continue
+
+                batch.append(
+                    pymongo.UpdateOne(
+                        {'_id': message.id},
+                        {
+                            '$setOnInsert': {
+                                'author': message.author.id,
+                                'guild': message.guild.id,
+                                'channel': message.channel.id,
+                                'parent_channel': None
+                                if not isinstance(message.channel, discord.Thread)
+                                else message.channel.parent_id,
+                                'timestamp': int(created.timestamp()),
+                            }
+                        },
+                        upsert=True,
+                    )
                 )
+                if len(batch) >= 500:
+                    write(batch, position)
+                    batch = []
+
+            if position:
+                write(batch, position)
+
+            if not gaps:
+                checkpoints.update_one({'_id': channel.id}, {'$set': {'complete': True}})
 
-        return x, y
+        state['fraction'] = 1
+        return state['processed'], state['recorded']
 
 
 async def setup(bot):
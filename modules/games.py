@@ -6,7 +6,6 @@ import re
 from datetime import datetime, timedelta, timezone
 from typing import Generator, Literal, Optional, Tuple, Union
 
-import aiohttp
 import config  # type: ignore
 import discord
 import pymongo
@@ -30,9 +29,10 @@ class RatelimitException(Exception):
 
 
 class GiantBomb:
-    def __init__(self, api_key):
+    def __init__(self, api_key, web: tools.HTTPClient):
         self.BASE_URL = 'https://www.giantbomb.com/api'
         self.api_key = api_key
+        self.web = web
 
         # Ratelimit burst limit 200, renews at 200 / 1hr
         self.bucket_storage = token_bucket.MemoryStorage()
@@ -55,62 +55,56 @@ class GiantBomb:
         offset = 0
 
         for _ in range(1, 1000):
-            async with aiohttp.ClientSession() as session:
-                self.raise_for_ratelimit(path)
-
-                params = {
-                    'api_key': self.api_key,
-                    'format': 'json',
-                    'limit': 100,
-                    'offset': offset,
-                    'sort': 'date_last_updated:asc',
-                }
+            self.raise_for_ratelimit(path)
 
-                # There is a bug in the GiantBomb API where if we want to fliter a platform and want to use another
-                # filter, we must place the platform in the filter key instead of using the platforms key.
-                # https://www.giantbomb.com/forums/api-developers-3017/unable-to-filter-games-by-date-added-1794952/#js-message-8288158
-                #
-                # Futhermore, confusingly, both the /games and /releases have a platforms key, however their filter
-                # subkey is either 'platform' or 'platforms', respectfully.
-                if after:
-                    after = after + timedelta(0, 1)  # Add 1 sec
-                    start = after.isoformat(" ", timespec="seconds")
-                    end = "2100-01-01 00:00:00"
-                    platform_s = 'platform' if path == 'releases' else 'platforms'
-                    params['filter'] = f'date_last_updated:{start}|{end},{platform_s}:{GIANTBOMB_NSW_ID}'
-                else:
-                    params['platforms'] = GIANTBOMB_NSW_ID
+            params = {
+                'api_key': self.api_key,
+                'format': 'json',
+                'limit': 100,
+                'offset': offset,
+                'sort': 'date_last_updated:asc',
+            }
+
+            # There is a bug in the GiantBomb API where if we want to fliter a platform and want to use another
+            # filter, we must place the platform in the filter key instead of using the platforms key.
+            # https://www.giantbomb.com/forums/api-developers-3017/unable-to-filter-games-by-date-added-1794952/#js-message-8288158
+            #
+            # Futhermore, confusingly, both the /games and /releases have a platforms key, however their filter
+            # subkey is either 'platform' or 'platforms', respectfully.
+            if after:
+                after = after + timedelta(0, 1)  # Add 1 sec
+                start = after.isoformat(" ", timespec="seconds")
+                end = "2100-01-01 00:00:00"
+                platform_s = 'platform' if path == 'releases' else 'platforms'
+                params['filter'] = f'date_last_updated:{start}|{end},{platform_s}:{GIANTBOMB_NSW_ID}'
+            else:
+                params['platforms'] = GIANTBOMB_NSW_ID
 
-                async with session.get(f'{self.BASE_URL}/{path}', params=params) as resp:
-                    resp.raise_for_status()
-                    resp_json = await resp.json()
+            resp_json = await self.web.get_json(f'{self.BASE_URL}/{path}', params=params)
 
-                    for item in resp_json['results']:
-                        yield item
+            for item in resp_json['results']:
+                yield item
 
-                    offset += resp_json['number_of_page_results']
-                    if offset >= int(resp_json['number_of_total_results']):  # releases returns this as a str
-                        break  # no more results
+            offset += resp_json['number_of_page_results']
+            if offset >= int(resp_json['number_of_total_results']):  # releases returns this as a str
+                break  # no more results
 
     async def fetch_item(self, path: Literal['game', 'release'], guid: str) -> Optional[dict]:
         if path not in ['game', 'release']:
             raise ValueError(f'invalid path: {path}')
 
-        async with aiohttp.ClientSession() as session:
-            self.raise_for_ratelimit(path)
+        self.raise_for_ratelimit(path)
 
-            params = {'api_key': self.api_key, 'format': 'json'}
-            async with session.get(f'{self.BASE_URL}/{path}/{guid}', params=params) as resp:
-                resp.raise_for_status()
-                resp_json = await resp.json()
+        params = {'api_key': self.api_key, 'format': 'json'}
+        resp_json = await self.web.get_json(f'{self.BASE_URL}/{path}/{guid}', params=params)
 
-                return resp_json['results'] if resp_json['results'] else None
+        return resp_json['results'] if resp_json['results'] else None
 
 
 class Games(commands.Cog, name='Games'):
     def __init__(self, bot):
         self.bot = bot
-        self.GiantBomb = GiantBomb(config.giantbomb)
+        self.GiantBomb = GiantBomb(config.giantbomb, bot.web)
         self.db = mclient.bowser.games
 
         self.last_sync = {
@@ -322,11 +316,7 @@ class Games(commands.Cog, name='Games'):
         if as_url:
             return url
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                resp.raise_for_status()
-                data = await resp.read()
-                return io.BytesIO(data)
+        return io.BytesIO(await self.bot.web.get_bytes(url))
 
     async def fetch_developers_publishers(
         self, type: Literal['games', 'releases'], guid: str
@@ -177,7 +177,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
         if duration and doc['type'] != 'mute':  # TODO: Should we support strikes in the future?
             return ctx.send(f'{config.redTick} Setting durations is not supported for {doc["type"]}')
 
-        user = await self.bot.fetch_user(doc['user'])
+        user = await self.bot.resolver.fetch(doc['user'])
         try:
             member = await ctx.guild.fetch_member(doc['user'])
 
@@ -210,6 +210,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
                 await member.edit(timed_out_until=_duration, reason='Mute duration modified by moderator')
 
             db.update_one({'_id': infraction}, {'$set': {'expiry': int(stamp)}})
+            self.bot.sanctions.refresh(doc['user'])
             await tools.send_modlog(
                 self.bot,
                 self.modLogs,
@@ -300,6 +301,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
         if not doc:  # Delete did nothing if doc is None
             return ctx.send(f'{config.redTick} No matching infraction found')
 
+        self.bot.sanctions.refresh(doc['user'])
         await ctx.send(f'{config.greenTick} removed {_id}: {doc["type"]} against {doc["user"]} by {doc["moderator"]}')
 
     @commands.command(name='ban', aliases=['banid', 'forceban'])
@@ -373,6 +375,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
                 continue
 
             docID = await tools.issue_pun(userid, ctx.author.id, 'ban', reason=reason)
+            self.bot.sanctions.refresh(userid)
             await tools.send_modlog(
                 self.bot,
                 self.modLogs,
@@ -426,6 +429,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
 
         db.find_one_and_update({'user': user, 'type': 'ban', 'active': True}, {'$set': {'active': False}})
         docID = await tools.issue_pun(user, ctx.author.id, 'unban', reason, active=False)
+        self.bot.sanctions.refresh(user)
         await ctx.guild.unban(userObj, reason='Unban action performed by moderator')
         await tools.send_modlog(
             self.bot,
@@ -528,8 +532,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
             return await ctx.send(
                 f'{config.redTick} Mute reason is too long, reduce it by at least {len(reason) - 990} characters'
             )
-        db = mclient.bowser.puns
-        if db.find_one({'user': member.id, 'type': 'mute', 'active': True}):
+        if self.bot.sanctions.has(member.id, 'mute'):
             return await ctx.send(f'{config.redTick} {member} ({member.id}) is already muted')
 
         try:
@@ -575,6 +578,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
         docID = await tools.issue_pun(
             member.id, ctx.author.id, 'mute', reason, int(_duration.timestamp()), public_notify=public_notify
         )
+        self.bot.sanctions.refresh(member.id)
         await tools.send_modlog(
             self.bot,
             self.modLogs,
@@ -614,6 +618,8 @@ class Moderation(commands.Cog, name='Moderation Commands'):
                 f'{config.redTick} Cannot unmute {member} ({member.id}), they are not currently muted'
             )
 
+        self.bot.sanctions.refresh(member.id)
+
         await member.edit(timed_out_until=None, reason='Unmute action performed by moderator')
 
         error = ""
@@ -673,16 +679,12 @@ class Moderation(commands.Cog, name='Moderation Commands'):
             return await ctx.send(
                 f'{config.redTick} Strike reason is too long, reduce it by at least {len(reason) - 990} characters'
             )
-        punDB = mclient.bowser.puns
         userDB = mclient.bowser.users
         userDoc = userDB.find_one({'_id': user.id})
         if not userDoc:
             return await ctx.send(f'{config.redTick} Unable strike user who has never joined the server')
 
-        activeStrikes = 0
-        for pun in punDB.find({'user': user.id, 'type': 'strike', 'active': True}):
-            activeStrikes += pun['active_strike_count']
-
+        activeStrikes = self.bot.sanctions.strikes(user.id)
         activeStrikes += count
         if activeStrikes > 16:  # Max of 16 active strikes
             return await ctx.send(
@@ -710,6 +712,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
         docID = await tools.issue_pun(
             user.id, ctx.author.id, 'strike', reason, strike_count=count, public=True, public_notify=public_notify
         )
+        self.bot.sanctions.refresh(user.id)
 
         await tools.send_modlog(
             self.bot,
@@ -737,11 +740,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
     @_strike.command(name='set')
     async def _strike_set(self, ctx, user: tools.ResolveUser, count: StrikeRange, *, reason):
         punDB = mclient.bowser.puns
-        activeStrikes = 0
-        puns = punDB.find({'user': user.id, 'type': 'strike', 'active': True})
-        for pun in puns:
-            activeStrikes += pun['active_strike_count']
-
+        activeStrikes = self.bot.sanctions.strikes(user.id)
         if activeStrikes == count:
             return await ctx.send(f'{config.redTick} That user already has {activeStrikes} active strikes')
 
@@ -787,6 +786,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
                     punDB.update_one({'_id': pun['_id']}, {'$set': {'active_strike_count': 0, 'active': False}})
                     diff -= pun['active_strike_count']
 
+            self.bot.sanctions.refresh(user.id)
             if diff != 0:  # Something has gone horribly wrong
                 raise ValueError('Diff != 0 after full iteration')
 
@@ -901,6 +901,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
             # Start logic
             if doc['active_strike_count'] - 1 == 0:
                 db.update_one({'_id': doc['_id']}, {'$set': {'active': False}, '$inc': {'active_strike_count': -1}})
+                self.bot.sanctions.refresh(doc['user'])
                 strikes = [
                     x for x in db.find({'user': doc['user'], 'type': 'strike', 'active': True}).sort('timestamp', 1)
                 ]
@@ -912,6 +913,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
 
             elif doc['active_strike_count'] > 0:
                 db.update_one({'_id': doc['_id']}, {'$inc': {'active_strike_count': -1}})
+                self.bot.sanctions.refresh(doc['user'])
                 self.schedule_task(60 * 60 * 12, doc['_id'], guild)
 
             else:
@@ -952,6 +954,7 @@ class Moderation(commands.Cog, name='Moderation Commands'):
                 public_notify = True
 
             newPun = db.find_one_and_update({'_id': doc['_id']}, {'$set': {'active': False}})
+            self.bot.sanctions.refresh(doc['user'])
             docID = await tools.issue_pun(
                 doc['user'],
                 self.bot.user.id,
@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import glob
 import io
 import logging
@@ -32,14 +33,102 @@ import tools  # type: ignore
 mclient = pymongo.MongoClient(config.mongoHost, username=config.mongoUser, password=config.mongoPass)
 
 
+class RenderQueue:
+    '''
+    Runs profile card renders on a fixed pool of workers. A request for a card that is already queued or rendering joins
+    that job instead of rendering it again, and queued jobs are taken from each channel in turn so one busy channel
+    cannot starve the others
+    '''
+
+    def __init__(self, render, workers: int = 2):
+        self.render = render  # Coroutine taking the job's arguments and returning the card bytes and filename
+        self.workers = workers
+        self.jobs = {}  # key: (future, args)
+        self.channels = collections.OrderedDict()  # channel id: deque of queued keys
+        self.available = asyncio.Semaphore(0)
+        self.tasks = []
+        self.running = 0
+        self.metrics = {'submitted': 0, 'coalesced': 0, 'completed': 0, 'failed': 0, 'maxDepth': 0, 'renderTime': 0.0}
+
+    @property
+    def depth(self) -> int:
+        return sum(len(x) for x in self.channels.values())
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+        # Fail every queued or in-progress job, otherwise requests waiting on them would never return
+        for future, _ in self.jobs.values():
+            if not future.done():
+                future.set_exception(RuntimeError('Profile render queue was stopped'))
+
+        self.jobs = {}
+        self.channels.clear()
+
+    async def submit(self, channel_id: int, key, *args) -> typing.Tuple[bytes, str]:
+        self.metrics['submitted'] += 1
+        if key in self.jobs:
+            self.metrics['coalesced'] += 1
+
+        else:
+            future = asyncio.get_running_loop().create_future()
+            # Retrieves a failure even if every request waiting on it was cancelled, so it is not reported as unhandled
+            future.add_done_callback(lambda x: x.cancelled() or x.exception())
+            self.jobs[key] = (future, args)
+            self.channels.setdefault(channel_id, collections.deque()).append(key)
+            self.metrics['maxDepth'] = max(self.metrics['maxDepth'], self.depth)
+            self.available.release()
+
+        # Shielded so one cancelled request does not cancel the render others are waiting on
+        return await asyncio.shield(self.jobs[key][0])
+
+    def _next_key(self):
+        channelID, queue = next(iter(self.channels.items()))
+        key = queue.popleft()
+        if queue:
+            self.channels.move_to_end(channelID)  # Round-robin, this channel waits for every other channel
+
+        else:
+            del self.channels[channelID]
+
+        return key
+
+    async def _worker(self):
+        while True:
+            await self.available.acquire()
+            key = self._next_key()
+            future, args = self.jobs[key]
+            self.running += 1
+            start = time.monotonic()
+            try:
+                future.set_result(await self.render(*args))
+                self.metrics['completed'] += 1
+
+            except Exception as e:
+                future.set_exception(e)
+                self.metrics['failed'] += 1
+
+            finally:
+                self.jobs.pop(key, None)  # Already gone if the queue was stopped
+                self.running -= 1
+                self.metrics['renderTime'] += time.monotonic() - start
+
+
 class SocialFeatures(commands.Cog, name='Social Commands'):
     def __init__(self, bot):
         self.bot = bot
         self.inprogressEdits = {}
+        self.bot.pipeline.register('SocialFeatures', self.process_message, priority=20)
 
         # !profile ratelimits
         self.bucket_storage = token_bucket.MemoryStorage()
         self.profile_bucket = token_bucket.Limiter(1 / 30, 2, self.bucket_storage)  # burst limit 2, renews at 1 / 30 s
+        self.renderQueue = RenderQueue(self._render_profile_card)
+        self.renderQueue.start()
 
         # Profile generation
         self.twemojiPath = 'resources/twemoji/assets/72x72/'
@@ -100,7 +189,7 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
 
         self.special_trophies = {
             'bot': lambda member, guild: member.bot,
-            'owner': lambda member, guild: member.id == guild.owner.id,
+            'owner': lambda member, guild: member.id == guild.owner_id,
             'developer': lambda member, guild: member.id in self.bot_contributors,
             'chat-mod': lambda member, guild: guild.get_role(config.chatmod) in member.roles,
             'sub-mod': lambda member, guild: guild.get_role(config.submod) in member.roles,
@@ -166,8 +255,25 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
                 delete_after=15,
             )
 
+        card, filename = await self.renderQueue.submit(ctx.channel.id, member.id, member)
+        await ctx.send(file=discord.File(io.BytesIO(card), filename=filename))
+
+    @commands.has_any_role(config.moderator, config.eh)
+    @_profile.command(name='queue')
+    async def _profile_queue(self, ctx):
+        '''Shows profile card render queue statistics'''
+        metrics = self.renderQueue.metrics
+        rendered = metrics['completed'] + metrics['failed']
+        avg = metrics['renderTime'] / rendered * 1000 if rendered else 0
+        return await ctx.send(
+            f'Profile render queue: {self.renderQueue.depth} queued, {self.renderQueue.running} rendering '
+            f'(peak depth {metrics["maxDepth"]}). {metrics["submitted"]} requests, {metrics["coalesced"]} coalesced, '
+            f'{metrics["completed"]} rendered, {metrics["failed"]} failed, {avg:.0f}ms average render'
+        )
+
+    async def _render_profile_card(self, member: discord.Member) -> typing.Tuple[bytes, str]:
         card = await self._generate_profile_card_from_member(member)
-        await ctx.send(file=card)
+        return card.fp.getvalue(), card.filename
 
     def _load_fonts(self, fonts_defs):
         '''Load normal and CJK versions of given dict of fonts'''
@@ -359,9 +465,28 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
         new_height = round((rows_required / square_length) * 900)
         canvas = canvas.resize((1600, new_height))
 
-        bytesFile = io.BytesIO()
-        canvas.save(bytesFile, format='PNG')
-        return discord.File(io.BytesIO(bytesFile.getvalue()), filename='preview.png')
+        return tools.encode_image(canvas, 'preview', config.profileEncoding)
+
+    async def _fetch_games(self, guids: typing.List[str], theme: dict) -> typing.List[typing.Tuple[str, Image.Image]]:
+        '''Resolves up to 3 favorite games to (preferred name, icon), looking up every name and icon concurrently'''
+        Games = self.bot.get_cog('Games')
+        if not Games:
+            return []
+
+        guids = list(dict.fromkeys(guids))[:3]  # Remove duplicates and limit to 3 results, just in case
+        gamesDb = mclient.bowser.games
+        results = await asyncio.gather(
+            *(asyncio.to_thread(Games.get_preferred_name, guid) for guid in guids),
+            *(self._cache_game_img(gamesDb, guid, theme) for guid in guids),
+        )
+        names, icons = results[: len(guids)], results[len(guids) :]
+        return [(name, icon) for name, icon in zip(names, icons) if name]
+
+    async def _fetch_flag(self, name: typing.Optional[str]) -> typing.Optional[Image.Image]:
+        if not name:
+            return None
+
+        return self.flagImgCache.get(name) or await asyncio.to_thread(self._cache_flag_image, name)
 
     async def _generate_profile_card_from_member(self, member: discord.Member) -> discord.File:
         db = mclient.bowser.users
@@ -374,25 +499,35 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
             backgrounds.insert(0, 'default-light')
 
             db.update_one({'_id': member.id}, {'$set': {'backgrounds': backgrounds}})
+            dbUser['backgrounds'] = backgrounds
 
             if dbUser['background'] == 'default':
                 db.update_one({'_id': member.id}, {'$set': {'background': 'default-light'}})
+                dbUser['background'] = 'default-light'
 
-            dbUser = db.find_one({'_id': member.id})
+        background = self.backgrounds[dbUser['background']]
+        theme = self.themes[background['theme']]
 
-        ## Get avatar ##
-        pfpBytes = io.BytesIO(await member.display_avatar.with_format('png').with_size(256).read())
-
-        ## Get message count, games ##
+        ## Get games ##
         if member.id in self.easter_egg_games:
             setGames = self.easter_egg_games[member.id]
-            message_count = random.choice(self.easter_egg_text)
+
         else:
             setGames = dbUser['favgames']
-            setGames = list(dict.fromkeys(setGames))  # Remove duplicates from list, just in case
-            setGames = setGames[:3]  # Limit to 3 results, just in case
 
-            message_count = f'{mclient.bowser.messages.find({"author": member.id}).count():,}'
+        ## Fetch avatar, message count, games and flag concurrently, the card waits only on the slowest ##
+        pfpBytes, messageCounts, games, flag = await asyncio.gather(
+            member.display_avatar.with_format('png').with_size(256).read(),
+            self.bot.get_cog('MainEvents').messageCounter.fetch(member.id),
+            self._fetch_games(setGames, theme),
+            self._fetch_flag(dbUser['regionFlag']),
+        )
+
+        if member.id in self.easter_egg_games:
+            message_count = random.choice(self.easter_egg_text)
+
+        else:
+            message_count = f'{messageCounts["total"]:,}'
 
         ## Get join date ##
         joins = dbUser['joins']
@@ -422,7 +557,7 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
         ## Get Trophies ##
         trophies = []
         if dbUser['trophyPreference']:
-            for x in dbUser:
+            for x in dbUser['trophyPreference']:
                 trophies.append(x)
 
         for trophy, lambda_function in self.special_trophies.items():
@@ -438,21 +573,22 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
             trophies.append(None)
 
         profile = {
-            'pfp': Image.open(pfpBytes),
+            'pfp': Image.open(io.BytesIO(pfpBytes)),
             'display_name': member.display_name,
             'username': str(member),
-            'regionFlag': dbUser['regionFlag'],
+            'regionFlag': flag,
             'friendcode': dbUser['friendcode'],
             'message_count': message_count,
             'joindate': joinDateF,
             'usertime': usertime,
             'trophies': trophies,
-            'games': setGames,
+            'games': games,
         }
 
-        return await self._generate_profile_card(profile, self.backgrounds[dbUser['background']])
+        # Compositing and encoding are CPU bound, so they run in a worker thread to let other renders proceed
+        return await asyncio.to_thread(self._generate_profile_card, profile, background)
 
-    async def _generate_profile_card(self, profile: dict, background: dict) -> discord.File:
+    def _generate_profile_card(self, profile: dict, background: dict) -> discord.File:
         theme = self.themes[background["theme"]]
 
         pfp = profile['pfp'].convert("RGBA").resize((250, 250))
@@ -499,7 +635,7 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
         self._draw_text(draw, (350, 275), profile['username'], theme["secondary"], fonts['subtext'])
 
         if profile['regionFlag']:
-            regionImg = self._cache_flag_image(profile['regionFlag'])
+            regionImg = profile['regionFlag']
             card.paste(regionImg, (976, 50), regionImg)
 
         # Friend code
@@ -547,25 +683,9 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
         gameIconLocations = {0: (60, 665), 1: (60, 730), 2: (60, 795)}
         gameTextLocations = {0: 660, 1: 725, 2: 791}
 
-        setGames = profile['games']
         gameCount = 0
-        Games = self.bot.get_cog('Games')
-        if setGames:
-            gamesDb = mclient.bowser.games
-
-            setGames = list(dict.fromkeys(setGames))  # Remove duplicates from list, just in case
-            setGames = setGames[:3]  # Limit to 3 results, just in case
-
-            for game_guid in setGames:
-                if not Games:
-                    continue
-
-                gameName = Games.get_preferred_name(game_guid)
-
-                if not gameName:
-                    continue
-
-                gameIcon = await self._cache_game_img(gamesDb, game_guid, theme)
+        if profile['games']:
+            for gameName, gameIcon in profile['games']:
                 card.paste(gameIcon, gameIconLocations[gameCount], gameIcon)
 
                 nameW = 120
@@ -587,9 +707,7 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
         if gameCount == 0:  # No games rendered
             self._draw_text(draw, (60, 665), 'Not specified', theme["secondary_heading"], fonts['medium'])
 
-        bytesFile = io.BytesIO()
-        card.save(bytesFile, format='PNG')
-        return discord.File(io.BytesIO(bytesFile.getvalue()), filename='profile.png')
+        return tools.encode_image(card, 'profile', config.profileEncoding)
 
     def check_flag(self, emoji: str) -> typing.Optional[typing.Iterable[int]]:
         # For some reason emoji emoji_data.is_emoji_tag_sequence() does not return correctly, so we have to write our own function
@@ -811,7 +929,7 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
             loading_message = await message.channel.send('Just a moment...')
 
             backgrounds = list(dbUser_phase5['backgrounds'])
-            preview = self._generate_background_preview(backgrounds)
+            preview = await asyncio.to_thread(self._generate_background_preview, backgrounds)
 
             await message.channel.send(phase5.format(', '.join(backgrounds)), file=preview)
             await loading_message.delete()
@@ -895,7 +1013,7 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
 
                             if user["_id"] != ctx.author.id:
                                 try:
-                                    fetchedUser = await self.bot.fetch_user(user["_id"])
+                                    fetchedUser = await self.bot.resolver.fetch(user["_id"])
                                     otherUsers.append(f'> **{str(fetchedUser)}** ({user["_id"]})')
                                 except:
                                     otherUsers.append(f'> {user["_id"]}')
@@ -994,20 +1112,24 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
 
         background = {'image': bg_rendered, 'theme': theme}
 
+        flag, games = await asyncio.gather(
+            self._fetch_flag("1f3f4-200d-2620-fe0f"),  # Pirate flag
+            self._fetch_games(['3030-88442', '3030-87348', '3030-89546'], self.themes[theme]),  # Really long titles
+        )
         profile = {
             'pfp': Image.new('RGB', (250, 250)),
             'display_name': "Lorem Ipsum Dolor Sit Amet, Esq",
             'username': "lorem_ipsum_dolor_sit_amet_esq",
-            'regionFlag': "1f3f4-200d-2620-fe0f",  # Pirate flag
+            'regionFlag': flag,
             'friendcode': "SW-0000-0000-0000",
             'message_count': "8,675,309",
             'joindate': "Jan. 01, 1970",
             'usertime': "Not specified",
             'trophies': [None] * 15,
-            'games': ['3030-88442', '3030-87348', '3030-89546'],  # Games with really long titles
+            'games': games,
         }
 
-        card = await self._generate_profile_card(profile, background)
+        card = await asyncio.to_thread(self._generate_profile_card, profile, background)
         cfgstr = f"```yml\n{safefilename}:\n    theme: {theme}\n    trophy-bg-opacity: {trophy_bg_opacity}```"
 
         await ctx.send(cfgstr, file=card)
@@ -1038,13 +1160,14 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
                 return await ctx.send(f'{config.redTick} Trophy cannot be granted via command: {name}')
 
         msg = await ctx.send(f'{config.loading} Granting {item.title()} `{name}` to {len(members)} member(s)...')
-        failCount = 0
-        for m in members:
-            try:
-                await tools.commit_profile_change(self.bot, m, item, name)
 
-            except ValueError:
-                failCount += 1
+        async def progress(sent, total):
+            await msg.edit(
+                content=f'{config.loading} Granted {item.title()} `{name}`, notified {sent}/{total} member(s)...'
+            )
+
+        result = await tools.commit_profile_change_bulk(self.bot, members, item, name, progress=progress)
+        failCount = len(result.skipped)
 
         if not failCount:
             # 0 Failures
@@ -1074,13 +1197,14 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
             return await ctx.send(f'{config.redTick} Trophy cannot be revoked via command: {name}')
 
         msg = await ctx.send(f'{config.loading} Revoking {item.title()} `{name}` from {len(members)} member(s)...')
-        failCount = 0
-        for m in members:
-            try:
-                await tools.commit_profile_change(self.bot, m, item, name, revoke=True)
 
-            except ValueError:
-                failCount += 1
+        async def progress(sent, total):
+            await msg.edit(
+                content=f'{config.loading} Revoked {item.title()} `{name}`, notified {sent}/{total} member(s)...'
+            )
+
+        result = await tools.commit_profile_change_bulk(self.bot, members, item, name, revoke=True, progress=progress)
+        failCount = len(result.skipped)
 
         if not failCount:
             # 0 Failures
@@ -1096,13 +1220,15 @@ class SocialFeatures(commands.Cog, name='Social Commands'):
                 content=f'{config.greenTick} {item.title()} `{name}` revoked from {len(members) - failCount}/{len(members)} member(s).'
             )
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
+    def cog_unload(self):
+        self.bot.pipeline.unregister('SocialFeatures')
+        self.renderQueue.stop()
+
+    async def process_message(self, message, parsed):
         if (not message.guild) or message.author.bot:
             return
 
-        content = re.sub(r'(<@!?\d+>)', '', message.content)
-        contains_code = tools.re_match_nonlink(self.friendCodeRegex['chatFilter'], content)
+        contains_code = parsed.match_nonlink(self.friendCodeRegex['chatFilter'])
 
         if not contains_code:
             return
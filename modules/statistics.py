@@ -178,12 +178,9 @@ class StatCommands(commands.Cog, name='Statistic Commands'):
             description='List of the 25 highest message senders and their count during the last 30 days\n',
             color=0xD267BA,
         )
+        senders = await self.bot.resolver.resolve_many((x[0] for x in topSenders), ctx.guild)
         for x in topSenders:
-            msgUser = ctx.guild.get_member(x[0])
-            if not msgUser:
-                msgUser = await self.bot.fetch_user(x[0])
-
-            embed.add_field(name=str(msgUser), value=str(x[1]))
+            embed.add_field(name=str(senders.get(x[0], x[0])), value=str(x[1]))
 
         return await msg.edit(content=None, embed=embed)
 
@@ -193,6 +190,8 @@ class StatCommands(commands.Cog, name='Statistic Commands'):
         self, ctx, *, role: typing.Optional[typing.Union[discord.Role, int, str]]
     ):  # TODO: create and pull role add/remove data from events
         '''Returns statistics on the ownership of roles'''
+        if not ctx.guild.chunked:  # Lazy member mode, role membership is only complete once members are chunked
+            await ctx.guild.chunk()
 
         if role:
             if type(role) is int:
@@ -205,13 +204,13 @@ class StatCommands(commands.Cog, name='Statistic Commands'):
                 if not role:
                     return await ctx.send(f'{config.redTick} There is no role by that name')
 
-            lines = []
-            desc = f'There are currently **{len(role.members)}** users with the **{role.name}** role:\n\n'
-            for member in role.members:
-                lines.append(f'* {member} ({member.id})')
+            memberIDs = self.bot.roleIndex.member_ids(role)
+            desc = f'There are currently **{len(memberIDs)}** users with the **{role.name}** role:\n\n'
+            members = filter(None, map(ctx.guild.get_member, memberIDs))
+            lines = (f'* {member} ({member.id})' for member in members)
 
             title = f'{ctx.guild.name} Role Statistics'
-            fields = tools.convert_list_to_fields(lines)
+            fields = tools.iter_fields(lines)
             return await tools.send_paginated_embed(
                 self.bot,
                 ctx.channel,
@@ -226,7 +225,7 @@ class StatCommands(commands.Cog, name='Statistic Commands'):
         else:
             roleCounts = []
             for role in reversed(ctx.guild.roles):
-                roleCounts.append(f'**{role.name}:** {len(role.members)}')
+                roleCounts.append(f'**{role.name}:** {self.bot.roleIndex.count(role)}')
 
             roleList = '\n'.join(roleCounts)
             embed = discord.Embed(
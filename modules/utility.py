@@ -1,14 +1,11 @@
 import asyncio
 import io
 import logging
-import pathlib
 import re
 import time
 import typing
-import urllib.parse
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
-import aiohttp
 import config
 import discord
 import pymongo
@@ -45,9 +42,21 @@ class ChatControl(commands.Cog, name='Utility Commands'):
             "tigerdirect.com": ["affiliateid", "srccode"],
             "walmart.*": ["sourceid", "veh", "wmlspartner"],
         }
+        self.affiliateRewriter = tools.AffiliateRewriter(self.affiliateTags)
+
+        # Recent affiliate reposts that their author may delete, keyed by the notice message ID. Older reposts and
+        # ones from other integrations are handled from the #mab_remover tag, see on_raw_reaction_add()
+        self.REPOST_RETENTION = 60 * 60 * 24 * 30
+        mclient.bowser.reposts.create_index([('date', pymongo.ASCENDING)], expireAfterSeconds=self.REPOST_RETENTION)
+        self.reposts = {}
+        recent = datetime.now(tz=timezone.utc) - timedelta(seconds=self.REPOST_RETENTION)
+        for doc in mclient.bowser.reposts.find({'date': {'$gt': recent}}):
+            self.reposts[doc['_id']] = doc
+            self.bot.reactions.register(doc['_id'], self.on_repost_reaction)
+        self.webhooks = {}  # Channel ID: repost webhook, invalidated by on_webhooks_update
 
     # Called after automod filter finished, because of the affilite link reposter. We also want to wait for other items in this function to complete to call said reposter.
-    async def on_automod_finished(self, message):
+    async def on_automod_finished(self, message, parsed=None):
         if message.type == discord.MessageType.premium_guild_subscription:
             boost_message = message.system_content.replace(
                 message.author.name, f'{message.author.name} ({message.author.mention})'
@@ -61,92 +70,92 @@ class ChatControl(commands.Cog, name='Utility Commands'):
 
         # Filter and clean affiliate links
         # We want to call this last to ensure all above items are complete.
-        links = tools.linkRe.finditer(message.content)
-        if links:
-            contentModified = False
-            content = message.content
-            for link in links:
-                linkModified = False
+        links = (parsed or tools.ParsedMessage(message.content)).links
+        if any(self.affiliateRewriter.is_candidate(link[0]) for link in links):
+            content = self.affiliateRewriter.rewrite(message.content, links)
+            if content:
+                webhook = await self.get_repost_webhook(message.channel)
+                send = dict(
+                    content=content,
+                    username=message.author.display_name,
+                    avatar_url=message.author.display_avatar.url,
+                    wait=True,
+                )
+                try:
+                    webhook_message = await webhook.send(**send)
+
+                except discord.NotFound:  # Deleted since it was cached, the update event may not have arrived yet
+                    self.webhooks.pop(message.channel.id, None)
+                    webhook = await self.get_repost_webhook(message.channel)
+                    webhook_message = await webhook.send(**send)
 
                 try:
-                    urlParts = urllib.parse.urlsplit(link[0])
-                except ValueError:  # Invalid URL edge case
-                    continue
+                    await message.delete()
+                except Exception:
+                    pass
 
-                urlPartsList = list(urlParts)
-
-                query_raw = dict(urllib.parse.parse_qsl(urlPartsList[3]))
-                # Make all keynames lowercase in dict, this shouldn't break a website, I hope...
-                query = {k.lower(): v for k, v in query_raw.items()}
-
-                # For each domain level of hostname, eg. foo.bar.example => foo.bar.example, bar.example, example
-                labels = urlParts.hostname.split(".")
-                for i in range(0, len(labels)):
-                    domain = ".".join(labels[i - len(labels) :])
-
-                    # Special case: rewrite 'amazon.*/exec/obidos/ASIN/.../' to 'amazon.*/dp/.../'
-                    if pathlib.PurePath(domain).match('amazon.*'):
-                        match = re.match(r'^/exec/obidos/ASIN/(\w+)/.*$', urlParts.path)
-                        if match:
-                            linkModified = True
-                            urlPartsList[2] = f'/dp/{match.group(1)}'  # 2 = path
-
-                    for glob, tags in self.affiliateTags.items():
-                        if pathlib.PurePath(domain).match(glob):
-                            for tag in tags:
-                                if tag in query:
-                                    linkModified = True
-                                    query.pop(tag, None)
-
-                if linkModified:
-                    urlPartsList[3] = urllib.parse.urlencode(query)
-                    url = urllib.parse.urlunsplit(urlPartsList)
-
-                    contentModified = True
-                    content = content.replace(link[0], url)
-
-            if contentModified:
-                useHook = None
-                for h in await message.channel.webhooks():
-                    if h.type == WebhookType.incoming and h.token:
-                        useHook = h
-
-                if not useHook:
-                    # An incoming webhook does not exist
-                    useHook = await message.channel.create_webhook(
-                        name=f'mab_{message.channel.id}',
-                        reason='No webhooks existed; 1 or more is required for affiliate filtering',
-                    )
+                embed = discord.Embed(
+                    description='The above message was automatically reposted by Mecha Bowser to remove an affiliate marketing link. The author may react with 🗑️ to delete these messages.'
+                )
 
-                async with aiohttp.ClientSession() as session:
-                    webhook = Webhook.from_url(useHook.url, session=session)
-                    webhook_message = await webhook.send(
-                        content=content,
-                        username=message.author.display_name,
-                        avatar_url=message.author.display_avatar.url,
-                        wait=True,
-                    )
+                # #mab_remover is the special sauce that allows users to delete their messages once the repost is no
+                # longer in the registry, see on_raw_reaction_add()
+                icon_url = f'{message.author.display_avatar.url}#mab_remover_{message.author.id}_{webhook_message.id}'
+                embed.set_footer(text=f'Author: {str(message.author)} ({message.author.id})', icon_url=icon_url)
+
+                # A seperate message is sent so that the original message has embeds
+                embed_message = await message.channel.send(embed=embed)
+                repost = {
+                    '_id': embed_message.id,
+                    'author': message.author.id,
+                    'message': webhook_message.id,
+                    'channel': message.channel.id,
+                    'date': datetime.now(tz=timezone.utc),
+                }
+                mclient.bowser.reposts.insert_one(repost)
+                self.reposts[embed_message.id] = repost
+                self.bot.reactions.register(embed_message.id, self.on_repost_reaction)
+                await embed_message.add_reaction('🗑️')
+
+    async def get_repost_webhook(self, channel) -> discord.Webhook:
+        '''Returns the cached incoming webhook used to repost messages in a channel, finding or creating one if needed'''
+        webhook = self.webhooks.get(channel.id)
+        if webhook:
+            return webhook
+
+        useHook = None
+        for h in await channel.webhooks():
+            if h.type == WebhookType.incoming and h.token:
+                useHook = h
+
+        if not useHook:
+            # An incoming webhook does not exist
+            useHook = await channel.create_webhook(
+                name=f'mab_{channel.id}',
+                reason='No webhooks existed; 1 or more is required for affiliate filtering',
+            )
 
-                    try:
-                        await message.delete()
-                    except Exception:
-                        pass
+        webhook = self.webhooks[channel.id] = Webhook.from_url(useHook.url, session=self.bot.web.session)
+        return webhook
 
-                    embed = discord.Embed(
-                        description='The above message was automatically reposted by Mecha Bowser to remove an affiliate marketing link. The author may react with 🗑️ to delete these messages.'
-                    )
+    @commands.Cog.listener()
+    async def on_webhooks_update(self, channel):
+        self.webhooks.pop(channel.id, None)
 
-                    # #mab_remover is the special sauce that allows users to delete their messages, see on_raw_reaction_add()
-                    icon_url = (
-                        f'{message.author.display_avatar.url}#mab_remover_{message.author.id}_{webhook_message.id}'
-                    )
-                    embed.set_footer(text=f'Author: {str(message.author)} ({message.author.id})', icon_url=icon_url)
+    # Handle :wastebasket: reactions for user deletions on messages reposted on a user's behalf
+    async def on_repost_reaction(self, payload):
+        if not payload.member:
+            return  # Not in a guild
+        if payload.emoji.name != '🗑️':
+            return  # Not a :wastebasket: emoji
 
-                    # A seperate message is sent so that the original message has embeds
-                    embed_message = await message.channel.send(embed=embed)
-                    await embed_message.add_reaction('🗑️')
+        repost = self.reposts[payload.message_id]
+        if await self._remove_repost(payload, repost['author'], repost['message']):
+            self.bot.reactions.unregister(payload.message_id)
+            del self.reposts[payload.message_id]
+            mclient.bowser.reposts.delete_one({'_id': payload.message_id})
 
-    # Handle :wastebasket: reactions for user deletions on messages reposed on a user's behalf
+    # Handle :wastebasket: reactions on reposts without a registry record, older ones or from other integrations
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
         if not payload.member:
@@ -155,18 +164,17 @@ class ChatControl(commands.Cog, name='Utility Commands'):
             return  # Not a :wastebasket: emoji
         if payload.user_id == self.bot.user.id:
             return  # This reaction was added by this bot
+        if payload.message_author_id != self.bot.user.id:
+            return  # Message is not from the bot
+        if payload.message_id in self.reposts:
+            return  # Handled by on_repost_reaction()
 
         channel = self.bot.get_channel(payload.channel_id)
         message = await channel.fetch_message(payload.message_id)
         embed = None if not message.embeds else message.embeds[0]
-
-        if message.author.id != self.bot.user.id:
-            return  # Message is not from the bot
         if not embed:
             return  # Message does not have an embed
 
-        allowed_remover = None
-        target_message = None
         # Search for special url tag in footer/author icon urls:
         # ...#mab_remover_{remover} or ..#mab_remover_{remover}_{message}
         for icon_url in [embed.author.icon_url, embed.footer.icon_url]:
@@ -174,32 +182,36 @@ class ChatControl(commands.Cog, name='Utility Commands'):
                 continue  # Location does not have an icon_url
 
             match = re.search(r'#mab_remover_(\d{15,25})(?:_(\d{15,25}))?$', icon_url)
-            if not match:
-                continue  # No special url tag here
-
-            allowed_remover = match.group(1)
-            target_message = match.group(2)
-            break
+            if match:
+                target = None if not match.group(2) else int(match.group(2))
+                await self._remove_repost(payload, int(match.group(1)), target)
+                return
 
-        if not allowed_remover:  # No special url tag detected
-            return
-        if str(payload.user_id) != str(allowed_remover):  # Reactor is not the allowed remover
+    async def _remove_repost(self, payload, allowed_remover: int, target_message: typing.Optional[int]) -> bool:
+        '''Deletes a repost notice and the reposted message if the reactor is the author. Returns True if deleted'''
+        channel = self.bot.get_channel(payload.channel_id)
+        if payload.user_id != allowed_remover:  # Reactor is not the allowed remover
             try:
-                await message.remove_reaction(payload.emoji, payload.member)
+                await channel.get_partial_message(payload.message_id).remove_reaction(payload.emoji, payload.member)
             except:
                 pass
-            return
+            return False
 
         try:
             if target_message:
-                msg = await channel.fetch_message(target_message)
-                await msg.delete()
+                await channel.get_partial_message(target_message).delete()
 
-            await message.delete()
+            await channel.get_partial_message(payload.message_id).delete()
         except Exception as e:
             logging.warning(e)
             pass
 
+        return True
+
+    def cog_unload(self):
+        for messageID in self.reposts:
+            self.bot.reactions.unregister(messageID)
+
     # Large block of old event commented out code was removed on 12/02/2020
     # Includes: Holiday season celebration, 30k members celebration, Splatoon splatfest event, Pokemon sword/shield event
     # https://github.com/rNintendoSwitch/MechaBowser/commit/373cef69aa5b9da7fe5945599b7dde387caf0700
@@ -218,15 +230,15 @@ class ChatControl(commands.Cog, name='Utility Commands'):
 
         if messages >= 100:
 
-            def confirm_check(reaction, member):
-                return member == ctx.author and str(reaction.emoji) in [config.redTick, config.greenTick]
+            def confirm_check(payload):
+                return payload.user_id == ctx.author.id and str(payload.emoji) in [config.redTick, config.greenTick]
 
             confirmMsg = await ctx.send(f'This action will delete up to {messages}, are you sure you want to proceed?')
             await confirmMsg.add_reaction(config.greenTick)
             await confirmMsg.add_reaction(config.redTick)
             try:
-                reaction = await self.bot.wait_for('reaction_add', timeout=15, check=confirm_check)
-                if str(reaction[0]) != config.greenTick:
+                payload = await self.bot.reactions.wait_for(confirmMsg.id, confirm_check, timeout=15)
+                if str(payload.emoji) != config.greenTick:
                     await confirmMsg.edit(content='Clean action canceled.')
                     return await confirmMsg.clear_reactions()
 
@@ -240,11 +252,25 @@ class ChatControl(commands.Cog, name='Utility Commands'):
         memberList = None if not members else [x.id for x in members]
 
         def message_filter(message):
-            return True if not memberList or message.author.id in memberList else False
+            if memberList and message.author.id not in memberList:
+                return False
+
+            self.bot.purgedMessages.set(message.id)  # Checked by on_bulk_message_delete before it archives
+            return True
 
         await ctx.message.delete()
         deleted = await ctx.channel.purge(limit=messages, check=message_filter, bulk=True)
 
+        archiveID = await tools.message_archive(reversed(deleted))
+        if archiveID:
+            embed = discord.Embed(
+                description=f'Archive URL: {config.baseUrl}/logs/{archiveID}',
+                color=0xF5A623,
+                timestamp=datetime.now(tz=timezone.utc),
+            )
+            embed.set_footer(text=f'Clean action by {ctx.author} ({ctx.author.id})')
+            await serverLogs.send(':printer: New message archive generated', embed=embed)
+
         m = await ctx.send(f'{config.greenTick} Clean action complete')
         return await m.delete(delay=5)
 
@@ -301,14 +327,14 @@ class ChatControl(commands.Cog, name='Utility Commands'):
 
     @commands.command(name='info')
     @commands.has_any_role(config.moderator, config.eh)
-    async def _info(self, ctx, user: typing.Union[discord.Member, int]):
+    async def _info(self, ctx, user: typing.Union[tools.ResolveMemberName, discord.Member, int]):
         inServer = True
         if type(user) == int:
             # User doesn't share the ctx server, fetch it instead
             dbUser = mclient.bowser.users.find_one({'_id': user})
             inServer = False
             try:
-                user = await self.bot.fetch_user(user)
+                user = await self.bot.resolver.fetch(user)
 
             except discord.NotFound:
                 return await ctx.send(f'{config.redTick} User does not exist')
@@ -334,8 +360,8 @@ class ChatControl(commands.Cog, name='Utility Commands'):
             dbUser = mclient.bowser.users.find_one({'_id': user.id})
 
         # Member object, loads of info to work with
-        messages = mclient.bowser.messages.find({'author': user.id})
-        msgCount = 0 if not messages else messages.count()
+        messageCounts = self.bot.get_cog('MainEvents').messageCounter.get(user.id)
+        msgCount = messageCounts['total']
 
         desc = (
             f'Fetched user {user.mention}.'
@@ -382,9 +408,7 @@ class ChatControl(commands.Cog, name='Utility Commands'):
 
         embed.add_field(name='Roles', value=roles, inline=False)
 
-        lastMsg = (
-            'N/a' if msgCount == 0 else f'<t:{int(messages.sort("timestamp", pymongo.DESCENDING)[0]["timestamp"])}:f>'
-        )
+        lastMsg = 'N/a' if not messageCounts['last'] else f'<t:{int(messageCounts["last"])}:f>'
         embed.add_field(name='Last message', value=lastMsg, inline=True)
         embed.add_field(name='Created', value=f'<t:{int(user.created_at.timestamp())}:f>', inline=True)
 
@@ -471,7 +495,7 @@ class ChatControl(commands.Cog, name='Utility Commands'):
         if type(user) == int:
             # User doesn't share the ctx server, fetch it instead
             try:
-                user = await self.bot.fetch_user(user)
+                user = await self.bot.resolver.fetch(user)
 
             except discord.NotFound:
                 return await ctx.send(f'{config.redTick} User does not exist')
@@ -543,56 +567,68 @@ class ChatControl(commands.Cog, name='Utility Commands'):
         else:
             desc = deictic_language['multiple_infs'][self_check].format(puns.count())
 
-        fields = []
         activeStrikes = 0
         totalStrikes = 0
-        for pun in puns.sort('timestamp', pymongo.DESCENDING):
-            datestamp = f'<t:{int(pun["timestamp"])}:f>'
-            moderator = ctx.guild.get_member(pun['moderator'])
-            if not moderator:
-                moderator = await self.bot.fetch_user(pun['moderator'])
-
+        strikeDocs = db.find(
+            {'user': user.id, 'type': {'$in': ['strike', 'destrike']}},
+            {'type': 1, 'strike_count': 1, 'active_strike_count': 1},
+        )
+        for pun in strikeDocs:
             if pun['type'] == 'strike':
                 activeStrikes += pun['active_strike_count']
                 totalStrikes += pun['strike_count']
-                inf = punNames[pun['type']].format(pun['strike_count'], "s" if pun['strike_count'] > 1 else "")
 
-            elif pun['type'] == 'destrike':
+            else:
                 totalStrikes -= pun['strike_count']
-                inf = punNames[pun['type']].format(pun['strike_count'], "s" if pun['strike_count'] > 1 else "")
 
-            elif pun['type'] in ['blacklist', 'unblacklist']:
-                inf = punNames[pun['type']].format(pun['context'])
+        # Read upfront, an open cursor would be killed by the server long before the paginator times out
+        punDocs = list(puns.sort('timestamp', pymongo.DESCENDING))
 
-            elif pun['type'] == 'appealdeny':
-                inf = punNames[pun['type']].format(f'<t:{int(pun["expiry"])}:D>')
+        async def history_fields():
+            # Consumed page by page as the history is viewed, so moderators are only resolved for viewed pages
+            for pun in punDocs:
+                datestamp = f'<t:{int(pun["timestamp"])}:f>'
+                try:
+                    moderator = await self.bot.resolver.fetch(pun['moderator'], ctx.guild)
 
-            else:
-                inf = punNames[pun['type']]
+                except discord.NotFound:
+                    moderator = pun['moderator']
 
-            value = f'**Moderator:** {moderator}\n**Details:** [{inf}] {pun["reason"]}'
+                if pun['type'] in ['strike', 'destrike']:
+                    inf = punNames[pun['type']].format(pun['strike_count'], "s" if pun['strike_count'] > 1 else "")
 
-            if len(value) > 1024:  # This shouldn't happen, but it does -- split long values up
-                strings = []
-                offsets = list(range(0, len(value), 1018))  # 1024 - 6 = 1018
+                elif pun['type'] in ['blacklist', 'unblacklist']:
+                    inf = punNames[pun['type']].format(pun['context'])
 
-                for i, o in enumerate(offsets):
-                    segment = value[o : (o + 1018)]
+                elif pun['type'] == 'appealdeny':
+                    inf = punNames[pun['type']].format(f'<t:{int(pun["expiry"])}:D>')
 
-                    if i == 0:  # First segment
-                        segment = f'{segment}...'
-                    elif i == len(offsets) - 1:  # Last segment
-                        segment = f'...{segment}'
-                    else:
-                        segment = f'...{segment}...'
+                else:
+                    inf = punNames[pun['type']]
 
-                    strings.append(segment)
+                value = f'**Moderator:** {moderator}\n**Details:** [{inf}] {pun["reason"]}'
 
-                for i, string in enumerate(strings):
-                    fields.append({'name': f'{datestamp} ({i+1}/{len(strings)})', 'value': string})
+                if len(value) > 1024:  # This shouldn't happen, but it does -- split long values up
+                    strings = []
+                    offsets = list(range(0, len(value), 1018))  # 1024 - 6 = 1018
 
-            else:
-                fields.append({'name': datestamp, 'value': value})
+                    for i, o in enumerate(offsets):
+                        segment = value[o : (o + 1018)]
+
+                        if i == 0:  # First segment
+                            segment = f'{segment}...'
+                        elif i == len(offsets) - 1:  # Last segment
+                            segment = f'...{segment}'
+                        else:
+                            segment = f'...{segment}...'
+
+                        strings.append(segment)
+
+                    for i, string in enumerate(strings):
+                        yield {'name': f'{datestamp} ({i+1}/{len(strings)})', 'value': string}
+
+                else:
+                    yield {'name': datestamp, 'value': value}
 
         if totalStrikes:
             desc = deictic_language['total_strikes'][self_check].format(activeStrikes, totalStrikes) + desc
@@ -609,7 +645,13 @@ class ChatControl(commands.Cog, name='Utility Commands'):
 
             author = {'name': f'{user} | {user.id}', 'icon_url': user.display_avatar.url}
             await tools.send_paginated_embed(
-                self.bot, channel, fields, title='Infraction History', description=desc, color=0x18EE1C, author=author
+                self.bot,
+                channel,
+                history_fields(),
+                title='Infraction History',
+                description=desc,
+                color=0x18EE1C,
+                author=author,
             )
 
         except discord.Forbidden:
@@ -648,7 +690,7 @@ class ChatControl(commands.Cog, name='Utility Commands'):
         for role in reversed(ctx.guild.roles):
             lines.append(f'{role.name} ({role.id})')
 
-        fields = tools.convert_list_to_fields(lines, codeblock=True)
+        fields = tools.iter_fields(lines, codeblock=True)
         return await tools.send_paginated_embed(
             self.bot,
             ctx.channel,
@@ -767,7 +809,7 @@ class ChatControl(commands.Cog, name='Utility Commands'):
             else:
                 lines = ['*No results found*']
 
-            fields = tools.convert_list_to_fields(lines, codeblock=False)
+            fields = tools.iter_fields(lines, codeblock=False)
             return await tools.send_paginated_embed(
                 self.bot,
                 ctx.channel,
@@ -813,15 +855,15 @@ class ChatControl(commands.Cog, name='Utility Commands'):
         await ctx.message.delete()
         if tag:
 
-            def confirm_check(reaction, member):
-                return member == ctx.author and str(reaction.emoji) in [config.redTick, config.greenTick]
+            def confirm_check(payload):
+                return payload.user_id == ctx.author.id and str(payload.emoji) in [config.redTick, config.greenTick]
 
             confirmMsg = await ctx.send(f'This action will delete the tag "{name}", are you sure you want to proceed?')
             await confirmMsg.add_reaction(config.greenTick)
             await confirmMsg.add_reaction(config.redTick)
             try:
-                reaction = await self.bot.wait_for('reaction_add', timeout=15, check=confirm_check)
-                if str(reaction[0]) != config.greenTick:
+                payload = await self.bot.reactions.wait_for(confirmMsg.id, confirm_check, timeout=15)
+                if str(payload.emoji) != config.greenTick:
                     await confirmMsg.edit(content='Delete canceled')
                     return await confirmMsg.clear_reactions()
 
@@ -1048,6 +1090,7 @@ class ChatControl(commands.Cog, name='Utility Commands'):
                 public_notify=public_notify,
             )
 
+        self.bot.sanctions.refresh(member.id)
         await tools.send_modlog(
             self.bot,
             self.modLogs,
@@ -1,16 +1,26 @@
 import asyncio
+import bisect
+import collections
+import fnmatch
+import io
+import json
 import logging
 import os
 import re
+import sqlite3
 import time
 import typing
 import urllib.parse
 import uuid
 from datetime import datetime, timedelta, timezone
 
+import aiohttp
 import config
 import discord
 import pymongo
+import zstandard
+from PIL import Image
+from unidecode import unidecode
 
 
 mclient = pymongo.MongoClient(config.mongoHost, username=config.mongoUser, password=config.mongoPass)
@@ -41,131 +51,184 @@ timeUnits = {
 # https://github.com/rNintendoSwitch/MechaBowser/commit/d1550f1f4951c35ca953e1ceacaae054fc9d4963
 
 
-async def message_archive(archive: typing.Union[discord.Message, list], edit=None):
-    db = mclient.modmail.logs
-    if type(archive) != list:
-        # Single message to archive
-        archive = [archive]
+ARCHIVE_CHUNK_SIZE = 100  # Messages per modmail.logChunks document
+ARCHIVE_INLINE_MESSAGES = 1000  # Messages also copied into the modmail.logs header, keeps it far below 16 MB
+PROFILE_RENDER_CONCURRENCY = 4  # Profile cards rendered at once for bulk profile changes
+PROFILE_DM_INTERVAL = 1  # Seconds between bulk profile change DMs
+
+
+def _archive_author(author):
+    return {
+        'id': str(author.id),
+        'name': author.name,
+        'discriminator': author.discriminator,
+        'avatar_url': author.display_avatar.with_format('png').with_size(1024).url,
+        'mod': False,
+    }
+
 
-    archiveID = f'{archive[0].id}-{int(time.time() * 1000)}'
-    if edit:
-        db.insert_one(
+class ArchiveWriter:
+    '''
+    Streams messages into a chunked archive. A header document is written to modmail.logs when the first message is
+    added, then every ARCHIVE_CHUNK_SIZE messages are written to modmail.logChunks as they are produced. Authors are
+    stored once in the header's lookup table and referenced by ID from each chunked message. Chunk bodies are zstd
+    compressed JSON, the message IDs of each chunk are kept uncompressed in the indexed archived_message_ids field.
+    Until the log viewer reads chunks, the first ARCHIVE_INLINE_MESSAGES messages are also copied into the header's
+    inline messages list in the original format. Longer archives are flagged truncated, the full archive is only in
+    the chunks
+    '''
+
+    def __init__(self, edit=False):
+        self.edit = edit
+        self.archiveID = None
+        self.authors = {}
+        self.buffer = []
+        self.chunks = 0
+        self.count = 0
+        self.inlined = 0
+        self.lastCreated = None
+
+    def _write_header(self, msg: discord.Message):
+        self.archiveID = f'{msg.id}-{int(time.time() * 1000)}'
+        mclient.modmail.logs.insert_one(
             {
-                '_id': archiveID,
-                'key': archiveID,
+                '_id': self.archiveID,
+                'key': self.archiveID,
                 'open': False,
-                'created_at': str(archive[0].created_at),
-                'closed_at': str(archive[0].created_at),
-                'channel_id': str(archive[0].channel.id),
-                'guild_id': str(archive[0].guild.id),
+                'created_at': str(msg.created_at),
+                'closed_at': str(msg.created_at),
+                'channel_id': str(msg.channel.id),
+                'guild_id': str(msg.guild.id),
                 'bot_id': str(config.parakarry),
                 'recipient': {
                     'id': 0,
-                    'name': archive[0].author.name,
-                    'discriminator': archive[0].author.discriminator,
-                    'avatar_url': archive[0].author.display_avatar.with_format('png').with_size(1024).url,
+                    'name': msg.author.name if self.edit else '',
+                    'discriminator': msg.author.discriminator if self.edit else 0,
+                    'avatar_url': _archive_author(msg.author)['avatar_url']
+                    if self.edit
+                    else 'https://cdn.discordapp.com/attachments/276036563866091521/695443024955834438/unknown.png',
                     'mod': False,
                 },
-                'creator': {
-                    'id': str(archive[0].author.id),
-                    'name': archive[0].author.name,
-                    'discriminator': archive[0].author.discriminator,
+                'creator': dict(_archive_author(msg.author), avatar_url=''),
+                'closer': {
+                    'id': str(0),
+                    'name': 'message edited' if self.edit else 'message archived',
+                    'discriminator': 0,
                     'avatar_url': '',
-                    'mod': False,
                 },
-                'closer': {'id': str(0), 'name': 'message edited', 'discriminator': 0, 'avatar_url': ''},
-                'messages': [
-                    {
-                        'timestamp': str(archive[0].created_at),
-                        'message_id': str(archive[0].id),
-                        'content': archive[0].content,
-                        'type': 'edit_before',
-                        'author': {
-                            'id': str(archive[0].author.id),
-                            'name': archive[0].author.name,
-                            'discriminator': archive[0].author.discriminator,
-                            'avatar_url': archive[0].author.display_avatar.with_format('png').with_size(1024).url,
-                            'mod': False,
-                        },
-                        'attachments': [x.url for x in archive[0].attachments],
-                    },
-                    {
-                        'timestamp': str(archive[1].created_at),
-                        'message_id': str(archive[1].id),
-                        'content': archive[1].content,
-                        'type': 'edit_after',
-                        'author': {
-                            'id': str(archive[1].author.id),
-                            'name': archive[1].author.name,
-                            'discriminator': archive[1].author.discriminator,
-                            'avatar_url': archive[1].author.display_avatar.with_format('png').with_size(1024).url,
-                            'mod': False,
-                        },
-                        'attachments': [x.url for x in archive[1].attachments],
-                    },
-                ],
+                'messages': [],
+                'chunked': True,
+                'complete': False,
             }
         )
 
-    else:
-        messages = []
-        for msg in archive:  # TODO: attachment CDN urls should be posted as message
-            messages.append(
-                {
-                    'timestamp': str(msg.created_at),
-                    'message_id': str(msg.id),
-                    'content': msg.content if msg.content else '',
-                    'type': 'thread_message',
-                    'author': {
-                        'id': str(msg.author.id),
-                        'name': msg.author.name,
-                        'discriminator': msg.author.discriminator,
-                        'avatar_url': msg.author.display_avatar.with_format('png').with_size(1024).url,
-                        'mod': False,
-                    },
-                    'channel': {'id': str(msg.channel.id), 'name': msg.channel.name},
-                    'attachments': [x.url for x in msg.attachments],
-                }
-            )
+    def add(self, msg: discord.Message):
+        if not self.archiveID:
+            self._write_header(msg)
+
+        authorID = str(msg.author.id)
+        if authorID not in self.authors:
+            self.authors[authorID] = _archive_author(msg.author)
 
-        db.insert_one(
+        if self.edit:
+            _type = 'edit_before' if self.count == 0 else 'edit_after'
+
+        else:
+            _type = 'thread_message'
+
+        self.buffer.append(
             {
-                '_id': archiveID,
-                'key': archiveID,
-                'open': False,
-                'created_at': str(archive[0].created_at),
-                'closed_at': str(archive[0].created_at),
-                'channel_id': str(archive[0].channel.id),
-                'guild_id': str(archive[0].guild.id),
-                'bot_id': str(config.parakarry),
-                'recipient': {
-                    'id': 0,
-                    'name': '',
-                    'discriminator': 0,
-                    'avatar_url': 'https://cdn.discordapp.com/attachments/276036563866091521/695443024955834438/unknown.png',
-                    'mod': False,
-                },
-                'creator': {
-                    'id': str(archive[0].author.id),
-                    'name': archive[0].author.name,
-                    'discriminator': archive[0].author.discriminator,
-                    'avatar_url': '',
-                    'mod': False,
-                },
-                'closer': {'id': str(0), 'name': 'message archived', 'discriminator': 0, 'avatar_url': ''},
-                'messages': messages,
+                'timestamp': str(msg.created_at),
+                'message_id': str(msg.id),
+                'content': msg.content if msg.content else '',
+                'type': _type,
+                'author': authorID,
+                'channel': {'id': str(msg.channel.id), 'name': msg.channel.name},
+                'attachments': [
+                    x.url for x in msg.attachments
+                ],  # TODO: attachment CDN urls should be posted as message
             }
         )
+        self.count += 1
+        self.lastCreated = msg.created_at
 
-    return archiveID
+        if len(self.buffer) >= ARCHIVE_CHUNK_SIZE:
+            self.flush()
 
+    def flush(self):
+        if not self.buffer:
+            return
 
-async def store_user(member, messages=0):
-    db = mclient.bowser.users
-    # Double check exists
-    if db.find_one({'_id': member.id}):
-        logging.error('Attempted to store user that already exists!')
-        return
+        mclient.modmail.logChunks.insert_one(
+            {
+                '_id': f'{self.archiveID}-{self.chunks}',
+                'archive': self.archiveID,
+                'index': self.chunks,
+                'archived_message_ids': [int(x['message_id']) for x in self.buffer],
+                'encoding': 'zstd-json',
+                'data': zstandard.ZstdCompressor().compress(json.dumps(self.buffer).encode()),
+            }
+        )
+        inline = [
+            dict(x, author=self.authors[x['author']]) for x in self.buffer[: ARCHIVE_INLINE_MESSAGES - self.inlined]
+        ]
+        if inline:
+            mclient.modmail.logs.update_one({'_id': self.archiveID}, {'$push': {'messages': {'$each': inline}}})
+            self.inlined += len(inline)
+
+        self.buffer = []
+        self.chunks += 1
+
+    def close(self) -> typing.Optional[str]:
+        '''Writes any remaining messages and finalises the header. Returns the archive ID, or None if empty'''
+        if not self.archiveID:
+            return None
+
+        self.flush()
+        mclient.modmail.logs.update_one(
+            {'_id': self.archiveID},
+            {
+                '$set': {
+                    'closed_at': str(self.lastCreated),
+                    'authors': self.authors,
+                    'chunks': self.chunks,
+                    'message_count': self.count,
+                    'truncated': self.inlined < self.count,
+                    'complete': True,
+                }
+            },
+        )
+        return self.archiveID
+
+
+def is_archived(message_id: int) -> bool:
+    return mclient.modmail.logChunks.find_one({'archived_message_ids': message_id}, projection={'_id': 1}) is not None
+
+
+async def message_archive(
+    archive: typing.Union[discord.Message, typing.Iterable[discord.Message], typing.AsyncIterable[discord.Message]],
+    edit=None,
+):
+    if isinstance(archive, discord.Message):
+        # Single message to archive
+        archive = [archive]
+
+    writer = ArchiveWriter(edit=bool(edit))
+    if hasattr(archive, '__aiter__'):
+        async for msg in archive:
+            writer.add(msg)
+
+    else:
+        for msg in archive:
+            writer.add(msg)
+
+    return writer.close()
+
+
+def new_user_doc(member, timestamp=None):
+    '''Builds a fresh bowser.users document for a member, joined at the given timestamp (defaults to now)'''
+    if timestamp is None:
+        timestamp = int(datetime.now(tz=timezone.utc).timestamp())
 
     roleList = []
     for role in member.roles:
@@ -174,17 +237,17 @@ async def store_user(member, messages=0):
 
         roleList.append(role.id)
 
-    userData = {
+    return {
         '_id': member.id,
         'roles': roleList,
-        'joins': [int(datetime.now(tz=timezone.utc).timestamp())],
+        'joins': [timestamp],
         'leaves': [],
         'nameHist': [
             {
                 'str': member.name,
                 'type': 'name',
                 'discriminator': member.discriminator,
-                'timestamp': int(datetime.now(tz=timezone.utc).timestamp()),
+                'timestamp': timestamp,
             }
         ],
         'lockdown': False,
@@ -200,7 +263,16 @@ async def store_user(member, messages=0):
         'background': 'default-light',
         'backgrounds': ['default-light', 'default-dark'],
     }
-    db.insert_one(userData)
+
+
+async def store_user(member, messages=0):
+    db = mclient.bowser.users
+    # Double check exists
+    if db.find_one({'_id': member.id}):
+        logging.error('Attempted to store user that already exists!')
+        return
+
+    db.insert_one(new_user_doc(member))
 
 
 async def issue_pun(
@@ -245,6 +317,685 @@ async def issue_pun(
     return docID
 
 
+class Sanction(typing.NamedTuple):
+    id: str
+    type: str
+    expiry: typing.Optional[int]
+    strikes: int
+    context: typing.Optional[str]
+
+
+class ActiveSanctions:
+    '''
+    In-memory index of active punishments keyed by user ID. Loaded once at startup and refreshed per user by the pun
+    write paths, so join, leave and automod checks can be answered without a database round-trip
+    '''
+
+    def __init__(self):
+        self.users = {}
+
+    @staticmethod
+    def _to_sanction(doc):
+        return Sanction(doc['_id'], doc['type'], doc['expiry'], doc['active_strike_count'] or 0, doc['context'])
+
+    def load(self):
+        db = mclient.bowser.puns
+        db.create_index([('user', pymongo.ASCENDING), ('active', pymongo.ASCENDING)])
+
+        users = {}
+        for doc in db.find({'active': True}):
+            users.setdefault(doc['user'], []).append(self._to_sanction(doc))
+
+        self.users = users
+        logging.info(f'[Sanctions] Indexed active punishments for {len(users)} users')
+
+    def refresh(self, user: int):
+        '''Re-reads a user's active punishments, call after any write that changes them'''
+        sanctions = [self._to_sanction(doc) for doc in mclient.bowser.puns.find({'user': user, 'active': True})]
+        if sanctions:
+            self.users[user] = sanctions
+
+        else:
+            self.users.pop(user, None)
+
+    def get(self, user: int, types: typing.Optional[typing.List[str]] = None) -> typing.List[Sanction]:
+        sanctions = self.users.get(user, [])
+        if types is None:
+            return list(sanctions)
+
+        return [x for x in sanctions if x.type in types]
+
+    def has(self, user: int, _type: str) -> bool:
+        return any(x.type == _type for x in self.users.get(user, []))
+
+    def strikes(self, user: int) -> int:
+        return sum(x.strikes for x in self.users.get(user, []) if x.type == 'strike')
+
+
+class TTLCache:
+    '''
+    Small dict-like store where each key expires a fixed number of seconds after it was set. Every key shares the same
+    TTL, so keys are kept in expiry order and purging only pops expired keys from the front, no background task is
+    needed
+    '''
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+
+    def _purge(self):
+        now = time.monotonic()
+        while self._data:
+            key, (expiry, _) = next(iter(self._data.items()))
+            if expiry > now:
+                break
+
+            del self._data[key]
+
+    def set(self, key, value=True):
+        self._purge()
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)  # Resetting a key moves it behind every key set before it
+
+    def get(self, key, default=None):
+        self._purge()
+        return self._data[key][1] if key in self._data else default
+
+    def pop(self, key, default=None):
+        self._purge()
+        return self._data.pop(key, (None, default))[1]
+
+    def __contains__(self, key):
+        self._purge()
+        return key in self._data
+
+    def __len__(self):
+        self._purge()
+        return len(self._data)
+
+
+class UserResolver:
+    '''
+    Resolves user IDs without a REST round-trip where possible: the guild member cache, then the client user cache,
+    then a TTL cache of users previously fetched. Concurrent requests for the same ID share one fetch, and no more
+    than `concurrency` fetches run at once
+    '''
+
+    def __init__(self, bot, ttl: float = 3600, concurrency: int = 5):
+        self.bot = bot
+        self.users = TTLCache(ttl)
+        self._pending = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def get(self, user_id: int, guild: typing.Optional[discord.Guild] = None):
+        '''Returns the member or user from cache only, or None'''
+        member = guild.get_member(user_id) if guild else None
+        return member or self.bot.get_user(user_id) or self.users.get(user_id)
+
+    async def _fetch(self, user_id: int) -> discord.User:
+        try:
+            async with self._semaphore:
+                user = await self.bot.fetch_user(user_id)
+
+            self.users.set(user_id, user)
+            return user
+
+        finally:
+            del self._pending[user_id]
+
+    async def fetch(self, user_id: int, guild: typing.Optional[discord.Guild] = None):
+        '''Returns the member or user, fetching it if not cached. Raises discord.NotFound if the user does not exist'''
+        user = self.get(user_id, guild)
+        if user:
+            return user
+
+        if user_id not in self._pending:
+            task = self._pending[user_id] = asyncio.create_task(self._fetch(user_id))
+            # Retrieves a failure even if every caller waiting on it was cancelled, so it is not reported as unhandled
+            task.add_done_callback(lambda x: x.cancelled() or x.exception())
+
+        # Shielded so a cancelled caller does not cancel the fetch other callers are waiting on
+        return await asyncio.shield(self._pending[user_id])
+
+    async def resolve_many(
+        self, user_ids: typing.Iterable[int], guild: typing.Optional[discord.Guild] = None
+    ) -> typing.Dict[int, typing.Union[discord.User, discord.Member]]:
+        '''Resolves each unique ID concurrently. IDs of users that do not exist are left out of the result'''
+        user_ids = list(dict.fromkeys(user_ids))
+        results = await asyncio.gather(*(self.fetch(x, guild) for x in user_ids), return_exceptions=True)
+        resolved = {}
+        for user_id, result in zip(user_ids, results):
+            if isinstance(result, discord.NotFound):
+                continue
+
+            if isinstance(result, BaseException):
+                raise result
+
+            resolved[user_id] = result
+
+        return resolved
+
+
+class MessageCounter:
+    '''
+    Materialised per-user message counts stored in bowser.messageCounts as
+    {_id: user, total, channels: {channel: count}, months: {YYYY-MM: count}, last: timestamp}.
+    Increments from the message ingest path are buffered in memory and written in bulk by flush()
+    '''
+
+    def __init__(self):
+        self.pending = {}
+
+    def increment(self, user: int, channel: int, timestamp: int):
+        counts = self.pending.get(user)
+        if not counts:
+            counts = self.pending[user] = {'total': 0, 'channels': {}, 'months': {}, 'last': 0}
+
+        month = datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m')
+        counts['total'] += 1
+        counts['channels'][str(channel)] = counts['channels'].get(str(channel), 0) + 1
+        counts['months'][month] = counts['months'].get(month, 0) + 1
+        counts['last'] = max(counts['last'], timestamp)
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, {}
+        operations = []
+        for user, counts in pending.items():
+            inc = {'total': counts['total']}
+            inc.update({f'channels.{k}': v for k, v in counts['channels'].items()})
+            inc.update({f'months.{k}': v for k, v in counts['months'].items()})
+            operations.append(
+                pymongo.UpdateOne({'_id': user}, {'$inc': inc, '$max': {'last': counts['last']}}, upsert=True)
+            )
+
+        mclient.bowser.messageCounts.bulk_write(operations, ordered=False)
+
+    def get(self, user: int) -> dict:
+        '''Returns the counter document for a user, including increments that have not been flushed yet'''
+        return self._merge_pending(user, mclient.bowser.messageCounts.find_one({'_id': user}))
+
+    async def fetch(self, user: int) -> dict:
+        '''Same as get(), but the stored counter is read in a worker thread'''
+        return self._merge_pending(user, await asyncio.to_thread(mclient.bowser.messageCounts.find_one, {'_id': user}))
+
+    def _merge_pending(self, user: int, doc: typing.Optional[dict]) -> dict:
+        doc = doc or {
+            '_id': user,
+            'total': 0,
+            'channels': {},
+            'months': {},
+            'last': None,
+        }
+        counts = self.pending.get(user)
+        if counts:
+            doc['total'] += counts['total']
+            for key in ['channels', 'months']:
+                for k, v in counts[key].items():
+                    doc[key][k] = doc[key].get(k, 0) + v
+
+            doc['last'] = max(doc['last'] or 0, counts['last'])
+
+        return doc
+
+    @staticmethod
+    def backfill() -> int:
+        '''
+        Rebuilds every counter document from bowser.messages. Counters are replaced outright, so messages ingested
+        while this runs may be counted twice once the buffer flushes. Returns the number of users written
+        '''
+        pipeline = [
+            {
+                '$group': {
+                    '_id': {
+                        'author': '$author',
+                        'channel': '$channel',
+                        'month': {
+                            '$dateToString': {
+                                'format': '%Y-%m',
+                                'date': {'$toDate': {'$multiply': ['$timestamp', 1000]}},
+                            }
+                        },
+                    },
+                    'count': {'$sum': 1},
+                    'last': {'$max': '$timestamp'},
+                }
+            },
+            {'$sort': {'_id.author': 1}},
+        ]
+
+        def replace(doc):
+            return pymongo.ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+
+        db = mclient.bowser.messageCounts
+        operations = []
+        users = 0
+        doc = None
+        for group in mclient.bowser.messages.aggregate(pipeline, allowDiskUse=True):
+            key = group['_id']
+            if not doc or doc['_id'] != key['author']:
+                if doc:
+                    operations.append(replace(doc))
+                    users += 1
+
+                doc = {'_id': key['author'], 'total': 0, 'channels': {}, 'months': {}, 'last': 0}
+
+            doc['total'] += group['count']
+            doc['channels'][str(key['channel'])] = doc['channels'].get(str(key['channel']), 0) + group['count']
+            doc['months'][key['month']] = doc['months'].get(key['month'], 0) + group['count']
+            doc['last'] = max(doc['last'], group['last'])
+
+            if len(operations) >= 1000:
+                db.bulk_write(operations, ordered=False)
+                operations = []
+
+        if doc:
+            operations.append(replace(doc))
+            users += 1
+
+        if operations:
+            db.bulk_write(operations, ordered=False)
+
+        return users
+
+
+class CachedMessage:
+    '''Compact record of a message kept by MessageCache, enough to log a delete or edit'''
+
+    __slots__ = ('id', 'author', 'channel', 'guild', 'content', 'attachments', 'created')
+
+    def __init__(self, id, author, channel, guild, content, attachments, created):
+        self.id = id
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.content = content
+        self.attachments = attachments
+        self.created = created
+
+    @classmethod
+    def from_message(cls, message: discord.Message):
+        return cls(
+            message.id,
+            message.author.id,
+            message.channel.id,
+            message.guild.id,
+            message.content,
+            tuple(x.proxy_url for x in message.attachments),
+            int(message.created_at.timestamp()),
+        )
+
+    @property
+    def jump_url(self):
+        return f'https://discord.com/channels/{self.guild}/{self.channel}/{self.id}'
+
+    def size(self):
+        # Rough footprint: object and slot overhead plus the strings we hold, content counted as UTF-8 bytes since
+        # non-ASCII text takes more than a byte per character
+        return 160 + len(self.content.encode()) + sum(len(x) + 50 for x in self.attachments)
+
+
+class MessageCache:
+    '''
+    Byte-budgeted LRU cache of CachedMessage records for delete and edit logging, used instead of keeping full
+    discord.py Message objects around. Records evicted from memory are optionally spilled to a local sqlite file and
+    pruned after spill_age seconds. Spill writes share one open transaction that is committed every
+    SPILL_COMMIT_INTERVAL seconds or SPILL_COMMIT_WRITES writes, instead of syncing to disk for every message
+    '''
+
+    SPILL_COMMIT_INTERVAL = 5
+    SPILL_COMMIT_WRITES = 1000
+
+    def __init__(self, budget: int, spill_path: typing.Optional[str] = None, spill_age: int = 60 * 60 * 24 * 7):
+        self.budget = budget
+        self.spill_age = spill_age
+        self.size = 0
+        self.messages = collections.OrderedDict()
+        self.spill = None
+        self._spilled = 0
+        self._uncommitted = 0
+        self._lastCommit = time.monotonic()
+
+        if spill_path:
+            self.spill = sqlite3.connect(spill_path)
+            self.spill.execute(
+                'CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, author INTEGER, channel INTEGER, '
+                'guild INTEGER, content TEXT, attachments TEXT, created INTEGER)'
+            )
+            self.spill.execute('CREATE INDEX IF NOT EXISTS messages_created ON messages (created)')
+            self._prune()
+
+    def add(self, message: discord.Message):
+        self._store(CachedMessage.from_message(message))
+
+    def _store(self, record: CachedMessage):
+        old = self.messages.pop(record.id, None)
+        if old:
+            self.size -= old.size()
+
+        self.messages[record.id] = record
+        self.size += record.size()
+
+        evicted = []
+        while self.size > self.budget and self.messages:
+            _, oldest = self.messages.popitem(last=False)
+            self.size -= oldest.size()
+            evicted.append(oldest)
+
+        if evicted and self.spill:
+            self.spill.executemany(
+                'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (x.id, x.author, x.channel, x.guild, x.content, json.dumps(x.attachments), x.created)
+                    for x in evicted
+                ],
+            )
+            self._spilled += len(evicted)
+            if self._spilled >= 10000:
+                self._prune()
+
+            self._written(len(evicted))
+
+    def _written(self, count: int):
+        # Uncommitted rows are already visible to reads on this connection, committing only makes them durable
+        self._uncommitted += count
+        if (
+            self._uncommitted >= self.SPILL_COMMIT_WRITES
+            or time.monotonic() - self._lastCommit >= self.SPILL_COMMIT_INTERVAL
+        ):
+            self.flush()
+
+    def flush(self):
+        '''Commits pending spill writes'''
+        if self.spill and self._uncommitted:
+            self.spill.commit()
+
+        self._uncommitted = 0
+        self._lastCommit = time.monotonic()
+
+    def _prune(self):
+        self._spilled = 0
+        self.spill.execute('DELETE FROM messages WHERE created < ?', (int(time.time() - self.spill_age),))
+        self.spill.commit()
+        self._uncommitted = 0
+        self._lastCommit = time.monotonic()
+
+    def get(self, message_id: int) -> typing.Optional[CachedMessage]:
+        record = self.messages.get(message_id)
+        if record:
+            self.messages.move_to_end(message_id)
+            return record
+
+        if self.spill:
+            row = self.spill.execute('SELECT * FROM messages WHERE id = ?', (message_id,)).fetchone()
+            if row:
+                return CachedMessage(*row[:5], tuple(json.loads(row[5])), row[6])
+
+        return None
+
+    def update(self, message: discord.Message):
+        '''Replaces the stored copy of an edited message, if we had one'''
+        if message.id in self.messages or (self.spill and self.get(message.id)):
+            self._store(CachedMessage.from_message(message))
+
+    def pop(self, message_id: int) -> typing.Optional[CachedMessage]:
+        record = self.get(message_id)
+        if record and message_id in self.messages:
+            self.size -= self.messages.pop(message_id).size()
+
+        if record and self.spill:
+            self.spill.execute('DELETE FROM messages WHERE id = ?', (message_id,))
+            self._written(1)
+
+        return record
+
+
+def normalize_name(name: str) -> str:
+    '''Folds a name down to a comparable form: transliterated to ASCII, casefolded and whitespace trimmed'''
+    return unidecode(name).casefold().strip()
+
+
+class NameIndex:
+    '''
+    Maps normalised names to the user IDs that have used them. Usernames (current and from nameHist) are kept apart
+    from display names (global names and nicknames) so callers can choose how loose a match they want. Names are never
+    removed, a past name stays resolvable just as it does in nameHist
+    '''
+
+    def __init__(self):
+        self.usernames = collections.defaultdict(set)
+        self.displayNames = collections.defaultdict(set)
+
+    def _add(self, index, user_id: int, name: typing.Optional[str]):
+        if name:
+            index[normalize_name(name)].add(user_id)
+
+    def add_user(self, user: typing.Union[discord.User, discord.Member]):
+        self._add(self.usernames, user.id, user.name)
+        if user.discriminator != '0':
+            self._add(self.usernames, user.id, str(user))
+
+        self._add(self.displayNames, user.id, user.global_name)
+        if isinstance(user, discord.Member):
+            self._add(self.displayNames, user.id, user.nick)
+
+    def _load_history(self):
+        for doc in mclient.bowser.users.find(
+            {'nameHist.0': {'$exists': True}}, {'nameHist.str': 1, 'nameHist.type': 1}
+        ):
+            for entry in doc['nameHist']:
+                index = self.usernames if entry.get('type') == 'name' else self.displayNames
+                self._add(index, doc['_id'], entry.get('str'))
+
+    async def load(self, guild: discord.Guild):
+        await asyncio.to_thread(self._load_history)
+        for member in guild.members:
+            self.add_user(member)
+
+        logging.info(f'[NameIndex] Indexed {len(self.usernames)} usernames and {len(self.displayNames)} display names')
+
+    def find(self, name: str, usernames_only=False) -> typing.Set[int]:
+        key = normalize_name(name)
+        if usernames_only:
+            return set(self.usernames.get(key, ()))
+
+        return self.usernames.get(key, set()) | self.displayNames.get(key, set())
+
+
+class RoleIndex:
+    '''
+    Sorted member ID lists per role, built once from the member cache and kept current from member join, update and
+    remove events. discord.py's Role.members scans every member of the guild, so counting members for each role that
+    way is O(roles x members)
+    '''
+
+    def __init__(self):
+        self.members = collections.defaultdict(list)
+        self.ready = False
+
+    def build(self, guild: discord.Guild):
+        members = collections.defaultdict(list)
+        for member in guild.members:
+            for role in member.roles[1:]:  # Skip @everyone, always first
+                members[role.id].append(member.id)
+
+        for memberIDs in members.values():
+            memberIDs.sort()
+
+        self.members = members
+        self.ready = True
+
+    def _add(self, role_id: int, member_id: int):
+        memberIDs = self.members[role_id]
+        i = bisect.bisect_left(memberIDs, member_id)
+        if i == len(memberIDs) or memberIDs[i] != member_id:
+            memberIDs.insert(i, member_id)
+
+    def _remove(self, role_id: int, member_id: int):
+        memberIDs = self.members.get(role_id, [])
+        i = bisect.bisect_left(memberIDs, member_id)
+        if i < len(memberIDs) and memberIDs[i] == member_id:
+            del memberIDs[i]
+
+    def add_member(self, member: discord.Member):
+        for role in member.roles[1:]:
+            self._add(role.id, member.id)
+
+    def remove_member(self, member: discord.Member):
+        for role in member.roles[1:]:
+            self._remove(role.id, member.id)
+
+    def update_member(self, before: discord.Member, after: discord.Member):
+        beforeRoles = {x.id for x in before.roles[1:]}
+        afterRoles = {x.id for x in after.roles[1:]}
+        for roleID in beforeRoles - afterRoles:
+            self._remove(roleID, after.id)
+
+        for roleID in afterRoles - beforeRoles:
+            self._add(roleID, after.id)
+
+    def remove_role(self, role: discord.Role):
+        self.members.pop(role.id, None)
+
+    def member_ids(self, role: discord.Role) -> typing.List[int]:
+        '''Returns member IDs with the role in ascending order, falling back to a member scan until the index is built'''
+        if role.is_default():
+            return sorted(x.id for x in role.guild.members)
+
+        if not self.ready:
+            return sorted(x.id for x in role.members)
+
+        return list(self.members.get(role.id, []))  # Copied, listings are consumed lazily while events arrive
+
+    def count(self, role: discord.Role) -> int:
+        if role.is_default():
+            return role.guild.member_count
+
+        if not self.ready:
+            return len(role.members)
+
+        return len(self.members.get(role.id, []))
+
+
+class HTTPResponse(typing.NamedTuple):
+    status: int
+    headers: typing.Mapping[str, str]
+    body: bytes
+    request_info: aiohttp.RequestInfo
+    history: tuple
+
+    def json(self):
+        '''Decodes the body as JSON. Raises aiohttp.ClientResponseError if it is not valid JSON'''
+        try:
+            return json.loads(self.body)
+
+        except ValueError as e:  # json.JSONDecodeError, or UnicodeDecodeError for non UTF-8 bodies
+            raise aiohttp.ClientResponseError(
+                self.request_info, self.history, status=self.status, message=f'Invalid JSON response: {e}'
+            ) from e
+
+
+class HTTPClient:
+    '''
+    Bot-wide HTTP client. One aiohttp session over a keep-alive connection pool with DNS caching and a per-host
+    connection limit, default timeouts, retries with exponential backoff for connection errors and retryable statuses,
+    and per-host request metrics. The underlying session is exposed for APIs that need one, such as webhooks
+    '''
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    MAX_RETRY_AFTER = 60  # Seconds, a longer Retry-After would hold the caller for too long
+
+    def __init__(self, *, limit=100, limit_per_host=8, dns_ttl=300, timeout=15, retries=3, backoff=0.5):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = None
+        self.metrics = collections.defaultdict(lambda: {'requests': 0, 'errors': 0, 'retries': 0, 'time': 0.0})
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit, limit_per_host=self.limit_per_host, ttl_dns_cache=self.dns_ttl, keepalive_timeout=30
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+    def _delay(self, attempt: int, retry_after: typing.Optional[str] = None) -> float:
+        try:
+            return min(float(retry_after), self.MAX_RETRY_AFTER)
+
+        except (TypeError, ValueError):
+            return self.backoff * 2**attempt
+
+    async def request(
+        self, method: str, url: str, *, retries: typing.Optional[int] = None, raise_for_status=True, **kwargs
+    ) -> HTTPResponse:
+        metrics = self.metrics[urllib.parse.urlsplit(url).hostname]
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            metrics['requests'] += 1
+            start = time.monotonic()
+            try:
+                async with self.session.request(method, url, **kwargs) as resp:
+                    body = await resp.read()
+                    metrics['time'] += time.monotonic() - start
+                    if resp.status in self.RETRY_STATUSES and attempt < retries:
+                        metrics['retries'] += 1
+                        await asyncio.sleep(self._delay(attempt, resp.headers.get('Retry-After')))
+                        continue
+
+                    if resp.status >= 400:
+                        metrics['errors'] += 1
+                        if raise_for_status:
+                            resp.raise_for_status()
+
+                    return HTTPResponse(resp.status, resp.headers, body, resp.request_info, resp.history)
+
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                metrics['time'] += time.monotonic() - start
+                metrics['errors'] += 1
+                if attempt >= retries:
+                    raise
+
+                metrics['retries'] += 1
+                await asyncio.sleep(self._delay(attempt))
+
+    async def get_json(self, url: str, **kwargs):
+        return (await self.request('GET', url, **kwargs)).json()
+
+    async def get_bytes(self, url: str, **kwargs) -> bytes:
+        return (await self.request('GET', url, **kwargs)).body
+
+
+IMAGE_ENCODINGS = {
+    # name: (format, file extension, save options)
+    'png': ('PNG', 'png', {'compress_level': 6}),  # Pillow's default
+    'png-fast': ('PNG', 'png', {'compress_level': 1}),
+    'png-palette': ('PNG', 'png', {'compress_level': 6}),  # Quantised to 256 colours before saving
+    'webp': ('WEBP', 'webp', {'quality': 90, 'method': 4}),
+    'webp-lossless': ('WEBP', 'webp', {'lossless': True, 'quality': 30, 'method': 2}),
+}
+
+
+def encode_image(image: Image.Image, name: str, encoding: str = 'png') -> discord.File:
+    '''Encodes a rendered image with one of IMAGE_ENCODINGS straight into the buffer handed to discord.File'''
+    imageFormat, extension, options = IMAGE_ENCODINGS[encoding]
+    if encoding == 'png-palette':
+        image = image.quantize(256, method=Image.Quantize.FASTOCTREE)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=imageFormat, **options)
+    buffer.seek(0)
+    return discord.File(buffer, filename=f'{name}.{extension}')
+
+
 def resolve_duration(data, include_seconds=False):
     """
     Takes a raw input string formatted 1w1d1h1m1s (any order)
@@ -326,54 +1077,132 @@ def mod_cmd_invoke_delete(channel):
     return not (channel.id in config.showModCTX or channel.category_id in config.showModCTX)
 
 
-async def commit_profile_change(bot, user: discord.User, element: str, item: str, revoke=False):
-    '''Given a user, update the owned status of a particular element (trophy, background, etc.), "item"'''
-    # Calling functions should be verifying availability of item
-    db = mclient.bowser.users
-    dbUser = db.find_one({'_id': user.id})
-    key = {'background': 'backgrounds', 'trophy': 'trophies'}[element]
-
-    if item in dbUser[key] and not revoke:
-        raise ValueError('Item is already granted to user')
-
-    if item not in dbUser[key] and revoke:
-        raise ValueError('Item is not granted to user')
+class ProfileChangeResult(typing.NamedTuple):
+    changed: typing.List[discord.User]
+    skipped: typing.List[discord.User]  # Already owned the item when granting, or did not own it when revoking
 
-    socialCog = bot.get_cog('Social Commands')
 
+def _profile_change_message(user: discord.User, element: str, item: str, revoke: bool) -> str:
     if not revoke:
-        db.update({'_id': user.id}, {'$push': {key: item}})
         dmMsg = f'Hey there {discord.utils.escape_markdown(user.name)}!\nYou have received a new item for your profile on the r/NintendoSwitch Discord server!\n\nThe **{item.replace("-", " ")}** {element} is now yours, enjoy! '
         if element == 'background':
             dmMsg += f'If you wish to use this background, use the `!profile edit` command in the <#{config.commandsChannel}> channel. Here\'s what your profile could look like:'
-            generated_background = socialCog._generate_background_preview([item])
 
         else:
             dmMsg += "Here's what your profile looks like with it:"
-            generated_background = await socialCog._generate_profile_card_from_member(user)
-
-        try:
-            await user.send(dmMsg, file=generated_background)
-
-        except (discord.NotFound, discord.Forbidden):
-            pass
 
     else:
-        db.update({'_id': user.id}, {'$pull': {key: item}})
-        # Reset background to default if the one being revoked is currently equiped
-        if dbUser['background'] == item and element == 'background':
-            db.update({'_id': user.id}, {'$set': {'background': 'default-light'}})
-
         dmMsg = f'Hey there {discord.utils.escape_markdown(user.name)},\nA profile item has been revoked from you on the r/NintendoSwitch Discord server.\n\nThe **{item.replace("-", " ")}** {element} was revoked from you. '
         if element == 'background':
-            f'If you were using this as your current background then your background has been reset to default. Use the `!profile edit` command in the <#{config.commandsChannel}> channel if you\'d like to change it.'
+            dmMsg += f'If you were using this as your current background then your background has been reset to default. Use the `!profile edit` command in the <#{config.commandsChannel}> channel if you\'d like to change it. '
         dmMsg += f'If you have questions about this action, please feel free to reach out to us via modmail by DMing <@{config.parakarry}>.'
 
-        try:
-            await user.send(dmMsg)
+    return dmMsg
 
-        except (discord.NotFound, discord.Forbidden):
-            pass
+
+async def commit_profile_change_bulk(
+    bot, users: typing.Iterable[discord.User], element: str, item: str, revoke=False, progress=None
+) -> ProfileChangeResult:
+    '''
+    Given users, update the owned status of a particular element (trophy, background, etc.), "item". The database is
+    changed with one query and one update for all users. Notification DMs are then rendered by a bounded pool of
+    workers and sent at a steady pace, calling the optional coroutine progress(sent, total) every few seconds
+    '''
+    # Calling functions should be verifying availability of item
+    db = mclient.bowser.users
+    key = {'background': 'backgrounds', 'trophy': 'trophies'}[element]
+    users = {user.id: user for user in users}
+
+    query = {'_id': {'$in': list(users)}, key: item if revoke else {'$ne': item}}
+    eligible = {doc['_id'] for doc in db.find(query, {'_id': 1})}
+    changed = [user for userID, user in users.items() if userID in eligible]
+    skipped = [user for userID, user in users.items() if userID not in eligible]
+    if not changed:
+        return ProfileChangeResult(changed, skipped)
+
+    changedIDs = [user.id for user in changed]
+    if not revoke:
+        db.update_many({'_id': {'$in': changedIDs}, key: {'$ne': item}}, {'$push': {key: item}})
+
+    else:
+        db.update_many({'_id': {'$in': changedIDs}}, {'$pull': {key: item}})
+        if element == 'background':
+            # Reset background to default if the one being revoked is currently equiped
+            db.update_many({'_id': {'$in': changedIDs}, 'background': item}, {'$set': {'background': 'default-light'}})
+
+    socialCog = bot.get_cog('Social Commands')
+    preview = None
+    if not revoke and element == 'background':
+        # Every user gets the same preview, render it once
+        previewFile = await asyncio.to_thread(socialCog._generate_background_preview, [item])
+        preview = (previewFile.fp.getvalue(), previewFile.filename)
+
+    pending = iter(changed)
+    sendQueue = asyncio.Queue(maxsize=PROFILE_RENDER_CONCURRENCY * 2)
+
+    async def render_worker():
+        for user in pending:  # Shared iterator, each worker takes the next user
+            if revoke:
+                file = None
+
+            elif preview:
+                file = discord.File(io.BytesIO(preview[0]), filename=preview[1])
+
+            else:
+                try:
+                    file = await socialCog._generate_profile_card_from_member(user)
+
+                except Exception:
+                    logging.exception(f'[Profiles] Unable to render profile card for {user.id}')
+                    file = None
+
+            await sendQueue.put((user, file))
+
+    async def send_worker():
+        sent = 0
+        lastReport = time.monotonic()
+        while True:
+            entry = await sendQueue.get()
+            if not entry:
+                break
+
+            user, file = entry
+            try:
+                await user.send(_profile_change_message(user, element, item, revoke), file=file)
+
+            except discord.HTTPException:  # DMs closed, or the user is gone. Keep the queue draining either way
+                pass
+
+            sent += 1
+            if progress and time.monotonic() - lastReport >= 5:
+                lastReport = time.monotonic()
+                try:
+                    await progress(sent, len(changed))
+
+                except Exception:  # Status message deleted or edit ratelimited, not worth stopping the DMs over
+                    logging.warning('[Profiles] Unable to report bulk profile change progress', exc_info=True)
+
+            await asyncio.sleep(PROFILE_DM_INTERVAL)
+
+    sender = asyncio.create_task(send_worker())
+    renderers = asyncio.gather(*(render_worker() for _ in range(PROFILE_RENDER_CONCURRENCY)))
+    try:
+        # If the sender dies the queue stops draining, so the renderers would block on it forever
+        await asyncio.wait({sender, renderers}, return_when=asyncio.FIRST_COMPLETED)
+        if sender.done():
+            renderers.cancel()
+            sender.result()
+
+        else:
+            await renderers
+            await sendQueue.put(None)
+            await sender
+
+    finally:
+        renderers.cancel()
+        sender.cancel()
+
+    return ProfileChangeResult(changed, skipped)
 
 
 async def send_modlog(
@@ -464,7 +1293,7 @@ async def send_public_modlog(bot, id, channel, mock_document=None):
     if not doc:
         return
 
-    user = await bot.fetch_user(doc['user'])
+    user = await bot.resolver.fetch(doc['user'])
 
     try:
         member = await channel.guild.fetch_member(doc['user'])
@@ -518,6 +1347,124 @@ async def send_public_modlog(bot, id, channel, mock_document=None):
         db.update_one({'_id': id}, {'$set': {'public_log_message': message.id, 'public_log_channel': channel.id}})
 
 
+class DomainRules:
+    '''
+    Domain glob rules ({glob: value}) compiled into lookup tables. A rule applies to a hostname if its glob matches any
+    dot-boundary suffix of it, eg. foo.bar.example is tested as foo.bar.example, bar.example and example. Exact domains
+    and `label.*` globs are dict lookups and `*` applies everywhere, only other globs fall back to compiled regexes
+    '''
+
+    def __init__(self, rules: dict):
+        self.everywhere = []
+        self.exact = {}
+        self.labels = {}
+        self.patterns = []
+
+        for glob, value in rules.items():
+            glob = glob.lower()
+            if glob == '*':
+                self.everywhere.append(value)
+
+            elif not any(c in glob for c in '*?['):
+                self.exact.setdefault(glob, []).append(value)
+
+            elif glob.endswith('.*') and not any(c in glob[:-2] for c in '*?[.'):
+                self.labels.setdefault(glob[:-2], []).append(value)
+
+            else:
+                self.patterns.append((re.compile(fnmatch.translate(glob)), value))
+
+    def match(self, hostname: str) -> typing.List:
+        '''Returns the values of every rule matching the hostname'''
+        values = list(self.everywhere)
+        labels = hostname.lower().split('.')
+        for i in range(len(labels)):
+            domain = '.'.join(labels[i:])
+            values.extend(self.exact.get(domain, []))
+            if i < len(labels) - 1:  # `label.*` needs at least one label after it
+                values.extend(self.labels.get(labels[i], []))
+
+            for pattern, value in self.patterns:
+                if pattern.match(domain):
+                    values.append(value)
+
+        return values
+
+    def matches(self, hostname: str) -> bool:
+        return bool(self.match(hostname))
+
+
+class AffiliateRewriter:
+    '''
+    Strips affiliate tracking parameters from links, as configured by {domain glob: [query keys]}, and rewrites
+    amazon.*/exec/obidos/ASIN/.../ links to amazon.*/dp/.../. Links without a query string or ASIN path are skipped
+    without being parsed
+    '''
+
+    asinRe = re.compile(r'^/exec/obidos/ASIN/(\w+)/.*$')
+    amazon = DomainRules({'amazon.*': True})
+
+    def __init__(self, tags: typing.Dict[str, typing.List[str]]):
+        self.rules = DomainRules(tags)
+
+    @staticmethod
+    def is_candidate(url: str) -> bool:
+        return '?' in url or '/exec/obidos/' in url
+
+    def rewrite_url(self, url: str) -> typing.Optional[str]:
+        '''Returns the cleaned url, or None if nothing was changed'''
+        if not self.is_candidate(url):
+            return None
+
+        try:
+            urlParts = urllib.parse.urlsplit(url)
+        except ValueError:  # Invalid URL edge case
+            return None
+
+        if not urlParts.hostname:
+            return None
+
+        urlPartsList = list(urlParts)
+        modified = False
+
+        # Special case: rewrite 'amazon.*/exec/obidos/ASIN/.../' to 'amazon.*/dp/.../'
+        if urlParts.path.startswith('/exec/obidos/') and self.amazon.matches(urlParts.hostname):
+            match = self.asinRe.match(urlParts.path)
+            if match:
+                modified = True
+                urlPartsList[2] = f'/dp/{match.group(1)}'  # 2 = path
+
+        if urlParts.query:
+            # Make all keynames lowercase in dict, this shouldn't break a website, I hope...
+            query = {k.lower(): v for k, v in urllib.parse.parse_qsl(urlParts.query)}
+            for tags in self.rules.match(urlParts.hostname):
+                for tag in tags:
+                    if tag in query:
+                        modified = True
+                        query.pop(tag, None)
+
+            urlPartsList[3] = urllib.parse.urlencode(query)
+
+        return urllib.parse.urlunsplit(urlPartsList) if modified else None
+
+    def rewrite(self, content: str, links: typing.Optional[typing.List[re.Match]] = None) -> typing.Optional[str]:
+        '''Returns the content with every link cleaned, or None if no link was changed'''
+        if links is None:
+            links = list(linkRe.finditer(content))
+
+        modified = False
+        for link in links:
+            url = self.rewrite_url(link[0])
+            if url:
+                modified = True
+                content = content.replace(link[0], url)
+
+        return content if modified else None
+
+
+reasonFilterWhitelist = DomainRules({x: True for x in reasonFilterWhitelistedDomains})
+
+
 def filter_links_from_reason(reason):
     links = reasonFilterLinkRe.finditer(reason)
     if links:
@@ -538,17 +1485,8 @@ def filter_links_from_reason(reason):
             urlPartsList = list(urlParts)
 
             # We can now modify the link
-            # For each domain level of hostname, eg. foo.bar.example => foo.bar.example, bar.example, example
-            labels = urlPartsList[1].split(".")
-            whitelisted = False
-            for i in range(0, len(labels)):
-                domain = ".".join(labels[i - len(labels) :])
-                if domain.lower() in reasonFilterWhitelistedDomains:
-                    whitelisted = True
-                    break
-
             # Not in whitelist
-            if not whitelisted:
+            if not reasonFilterWhitelist.matches(urlPartsList[1]):
                 urlPartsList[1] = ''.join(['•' if c != '.' else '.' for c in urlPartsList[1]])
 
             urlPartsList[2] = ''.join(['•' if c != '/' else '/' for c in urlPartsList[2]])
@@ -611,20 +1549,26 @@ def format_pundm(_type, reason, moderator=None, details=None, auto=False):
     return punDM
 
 
-def spans_overlap_link(string: str, spans: typing.List[typing.Tuple[int, int]]) -> typing.List[bool]:
+def spans_overlap_link(
+    string: str,
+    spans: typing.List[typing.Tuple[int, int]],
+    link_spans: typing.Optional[typing.List[typing.Tuple[int, int]]] = None,
+) -> typing.List[bool]:
     """
     Returns list of booleans for every character span passed (as `(start, end)`) if they overlap a link in given string.
+    Link spans already found in the string may be passed to skip searching it again.
     """
     START, END = (0, 1)  # Consts for readablity of (start, end) tuples
 
-    links = linkRe.finditer(string)
-
     if not spans:
         return []
-    if not links:
+
+    if link_spans is None:
+        link_spans = list(map(lambda m: m.span(), linkRe.finditer(string)))
+
+    if not link_spans:
         return [False] * len(spans)
 
-    link_spans = list(map(lambda m: m.span(), links))
     overlaps = [False] * len(spans)
 
     for i, span in enumerate(spans):
@@ -656,182 +1600,363 @@ def re_match_nonlink(pattern: typing.Pattern, string: str) -> typing.Optional[bo
     return any(not overlap for overlap in overlaps)
 
 
-async def send_paginated_embed(
-    bot: discord.ext.commands.Bot,
-    channel: discord.TextChannel,
-    fields: typing.List[typing.Dict],  # name: str , value: str, inline: optional bool
-    *,
-    owner: typing.Optional[discord.User] = None,
-    timeout: int = 600,
-    title: typing.Optional[str] = '',
-    description: typing.Optional[str] = None,
-    color: typing.Union[discord.Colour, int, None] = None,
-    author: typing.Optional[typing.Dict] = None,
-    page_character_limit: typing.Optional[int] = 6000,
-) -> discord.Message:  # author = name: str, icon_url: optional str
-    '''Displays an interactive paginated embed of given fields, with optional owner-locking, until timed out.'''
+mentionRe = re.compile(r'<@!?(\d+)>')
+customEmojiRe = re.compile(r'<(a?):(\w+):(\d+)>')
 
-    PAGE_TEMPLATE = '(Page {0}/{1})'
-    FOOTER_INSTRUCTION = '⬅️ / ➡️ Change Page   ⏹️ End'
-    FOOTER_ENDED_BY = 'Ended by {0}'
 
-    # Find the page character cap
-    footer_max_length = (
-        len(PAGE_TEMPLATE) + max(len(FOOTER_INSTRUCTION), len(FOOTER_ENDED_BY.format('-' * 37))) + 4
-    )  # 37 = max len(discordtag...#0000)
-    title_max_length = len(title) + len(FOOTER_INSTRUCTION) + 1
-    description_length = 0 if not description else len(description)
-    author_length = 0 if not author else len(author['name'])
+class ParsedMessage:
+    '''
+    A message's content parsed once by the MessagePipeline. `links`, `mentions` (users) and `emoji` (custom) are
+    regex matches over the content. `text` is the content with user mentions removed, `text_link_spans` are the link
+    spans shifted to line up with it
+    '''
 
-    page_char_cap = page_character_limit - footer_max_length - title_max_length - description_length - author_length
+    __slots__ = ('content', 'links', 'mentions', 'emoji', 'text', 'text_link_spans', '_removed')
 
-    # Build pages
-    pages = []
-    while fields:
-        remaining_chars = page_char_cap
-        page = []
+    def __init__(self, content: str):
+        self.content = content
+        self.links = list(linkRe.finditer(content))
+        self.mentions = list(mentionRe.finditer(content))
+        self.emoji = list(customEmojiRe.finditer(content))
 
-        # Make sure a field won't max out this page
-        for field in fields.copy():
-            field_length = len(field['name']) + len(field['value'])
+        pieces = []
+        last = 0
+        self._removed = []
+        for mention in self.mentions:
+            pieces.append(content[last : mention.start()])
+            last = mention.end()
+            self._removed.append(mention.span())
 
-            if remaining_chars - field_length < 0:
-                break
-            remaining_chars -= field_length
+        pieces.append(content[last:])
+        self.text = ''.join(pieces)
+        self.text_link_spans = [(self._shift(x.start()), self._shift(x.end())) for x in self.links]
 
-            page.append(fields.pop(0))
+    def _shift(self, pos: int) -> int:
+        # Maps a position in content to the same position in text
+        offset = 0
+        for start, end in self._removed:
+            if pos >= end:
+                offset += end - start
 
-            if len(page) == 25:
+            elif pos > start:
+                offset += pos - start
+
+            else:
                 break
 
-        pages.append(page)
+        return pos - offset
 
-    current_page = 1
-    ended_by = None
-    message = None
+    def match_nonlink(self, pattern: typing.Pattern) -> typing.Optional[bool]:
+        '''re_match_nonlink() against `text`, reusing the already parsed links'''
+        spans = [x.span() for x in re.finditer(pattern, self.text)]
+        if not spans:
+            return None
 
-    single_page = len(pages) <= 1
-    dm_channel = not isinstance(channel, discord.TextChannel) and not isinstance(channel, discord.Thread)
+        overlaps = spans_overlap_link(self.text, spans, self.text_link_spans)
+        return any(not overlap for overlap in overlaps)
 
-    if not (single_page or dm_channel):
-        # Setup messages, we wait to update the embed later so users don't click reactions before we're setup
-        message = await channel.send('Please wait...')
-        await message.add_reaction('⬅')
-        await message.add_reaction('⏹')
-        await message.add_reaction('➡')
 
-    # Init embed
-    embed = discord.Embed(description=None if not description else description, colour=color)
-    if author:
-        embed.set_author(name=author['name'], icon_url=None if not 'icon_url' in author else author['icon_url'])
-    embed.set_footer(icon_url=None if not owner else owner.display_avatar.url)
+class MessagePipeline:
+    '''
+    Parses each incoming message once and hands it, with its ParsedMessage, to registered consumers. Consumers are
+    coroutines taking (message, parsed) and are registered by name so reloading a cog replaces its entry. They are
+    started in ascending priority order and run concurrently, as separate on_message listeners did, so a slow consumer
+    (such as command processing) does not hold up the others. A failing consumer is reported through the bot's
+    on_error handler and does not affect the rest
+    '''
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.consumers = []
+
+    def register(self, name: str, callback, priority: int = 100):
+        self.unregister(name)
+        self.consumers.append((priority, name, callback))
+        self.consumers.sort(key=lambda x: x[0])
+
+    def unregister(self, name: str):
+        self.consumers = [x for x in self.consumers if x[1] != name]
+
+    async def _run(self, name, callback, message, parsed):
+        try:
+            await callback(message, parsed)
+
+        except Exception:
+            logging.error(f'[Pipeline] Consumer {name} failed to process message {message.id}')
+            await self.bot.on_error('on_message', message)
+
+    async def dispatch(self, message: discord.Message):
+        parsed = ParsedMessage(message.content)
+        await asyncio.gather(*(self._run(name, callback, message, parsed) for _, name, callback in self.consumers))
+
+
+class ReactionDispatcher:
+    '''
+    Routes raw reaction payloads to handlers registered for a message ID, so reactions on any other message are dropped
+    with a single dict lookup. Handlers are coroutines taking the payload. wait_for() replaces bot.wait_for('reaction_add')
+    predicates, which run against every reaction the bot sees
+    '''
+
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, message_id: int, handler):
+        self.handlers[message_id] = handler
+
+    def unregister(self, message_id: int):
+        self.handlers.pop(message_id, None)
+
+    async def dispatch(self, payload: discord.RawReactionActionEvent):
+        handler = self.handlers.get(payload.message_id)
+        if handler:
+            await handler(payload)
+
+    async def wait_for(self, message_id: int, check, timeout: float) -> discord.RawReactionActionEvent:
+        '''Waits for a reaction on a message passing check(payload). Raises asyncio.TimeoutError'''
+        future = asyncio.get_running_loop().create_future()
+
+        async def handler(payload):
+            if not future.done() and check(payload):
+                future.set_result(payload)
+
+        self.register(message_id, handler)
+        try:
+            return await asyncio.wait_for(future, timeout)
+
+        finally:
+            self.unregister(message_id)
+
+
+class PageSource:
+    '''
+    Packs embed fields into pages on demand. Fields can be a list or a sync or async iterable, so a generator over a
+    database cursor is only consumed as far as the pages a user actually views
+    '''
+
+    def __init__(self, fields, char_cap: int):
+        self.char_cap = char_cap
+        self.pages = []
+        self._aiter = fields.__aiter__() if hasattr(fields, '__aiter__') else None
+        self._iter = None if self._aiter else iter(fields)
+        self._pending = None
+        self._exhausted = False
+
+    @property
+    def done(self) -> bool:
+        return self._exhausted and self._pending is None
 
-    # Main loop
-    while True:  # Loop end conditions: User request, reaction listening timeout, or only 1 page (short circuit)
-        # Add Fields
-        embed.clear_fields()
-        if len(pages) != 0:
-            for field in pages[current_page - 1]:
-                embed.add_field(
-                    name=field['name'], value=field['value'], inline=True if not 'inline' in field else field['inline']
-                )
-
-        page_text = PAGE_TEMPLATE.format(current_page, max(len(pages), 1))
-        embed.title = f'{title} {page_text}'
-
-        if single_page or dm_channel:
-            embed.set_footer(text=page_text)
-            await channel.send(embed=embed)
-
-        if single_page:
-            break
-
-        elif dm_channel:
-            if current_page >= 10:
-                if len(pages) > 10:
-                    await channel.send(
-                        f'Limited to 10 pages in DM channel. {len(pages) - 10} page{"s were" if len(pages) != 1 else " was"} not sent'
-                    )
+    async def _next_field(self) -> typing.Optional[typing.Dict]:
+        if self._pending is not None:
+            field, self._pending = self._pending, None
+            return field
+
+        if self._exhausted:
+            return None
+
+        try:
+            return await self._aiter.__anext__() if self._aiter else next(self._iter)
+
+        except (StopIteration, StopAsyncIteration):
+            self._exhausted = True
+            return None
+
+    async def _build_page(self):
+        remaining_chars = self.char_cap
+        page = []
+        while len(page) < 25:
+            field = await self._next_field()
+            if field is None:
                 break
 
-            elif current_page == len(pages):
+            field_length = len(field['name']) + len(field['value'])
+            if page and remaining_chars - field_length < 0:
+                self._pending = field
                 break
 
-            else:
-                current_page += 1
-                continue
+            remaining_chars -= field_length
+            page.append(field)
 
-        else:
-            embed.set_footer(text=f'{page_text}    {FOOTER_INSTRUCTION}', icon_url=embed.footer.icon_url)
-            await message.edit(content='', embed=embed)
+        if page:
+            self.pages.append(page)
+
+        if self._pending is None:  # Look ahead so we know if this was the last page
+            self._pending = await self._next_field()
 
-        # Check user reaction
-        def check(reaction, user):
-            if user.id == bot.user.id:
-                return False
-            if owner and user.id != owner.id:
-                return False
+    async def get(self, index: int) -> typing.Optional[typing.List[typing.Dict]]:
+        while len(self.pages) <= index and not self.done:
+            await self._build_page()
 
-            if reaction.message.id != message.id:
-                return False
-            if not reaction.emoji in ['⬅', '➡', '⏹']:
-                return False
+        return self.pages[index] if index < len(self.pages) else None
+
+    async def count(self) -> int:
+        while not self.done:
+            await self._build_page()
+
+        return len(self.pages)
+
+
+class Paginator(discord.ui.View):
+    PAGE_TEMPLATE = '(Page {0}/{1})'
+    FOOTER_ENDED_BY = 'Ended by {0}'
+
+    def __init__(self, source: PageSource, embed: discord.Embed, title: str, owner=None, timeout: int = 600):
+        super().__init__(timeout=timeout)
+        self.source = source
+        self.embed = embed
+        self.title = title
+        self.owner = owner
+        self.current = 0
+        self.message = None
+
+    def page_text(self) -> str:
+        total = max(len(self.source.pages), 1) if self.source.done else '?'
+        return self.PAGE_TEMPLATE.format(self.current + 1, total)
+
+    async def render(self, footer: typing.Optional[str] = None) -> discord.Embed:
+        page = await self.source.get(self.current) or []
+        self.embed.clear_fields()
+        for field in page:
+            self.embed.add_field(name=field['name'], value=field['value'], inline=field.get('inline', True))
+
+        page_text = self.page_text()
+        self.embed.title = f'{self.title} {page_text}'
+        self.embed.set_footer(
+            text=f'{page_text}    {footer}' if footer else page_text, icon_url=self.embed.footer.icon_url
+        )
+
+        self.previous_page.disabled = self.current == 0
+        self.next_page.disabled = self.source.done and self.current >= len(self.source.pages) - 1
+        return self.embed
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if self.owner and interaction.user.id != self.owner.id:
+            await interaction.response.send_message(
+                'Only the user who ran this command can change pages', ephemeral=True
+            )
+            return False
 
-            return True
+        return True
 
-        # Catch timeout
+    @discord.ui.button(emoji='⬅', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
+        self.current = max(self.current - 1, 0)
+        await interaction.edit_original_response(embed=await self.render(), view=self)
+
+    @discord.ui.button(emoji='⏹', style=discord.ButtonStyle.secondary)
+    async def end(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
+        self.stop()
+        embed = await self.render(self.FOOTER_ENDED_BY.format(interaction.user))
+        await interaction.edit_original_response(embed=embed, view=None)
+
+    @discord.ui.button(emoji='➡', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        # Building a page can resolve users over REST, acknowledge first so the interaction does not expire
+        await interaction.response.defer()
+        if await self.source.get(self.current + 1):
+            self.current += 1
+
+        await interaction.edit_original_response(embed=await self.render(), view=self)
+
+    async def on_timeout(self):
         try:
-            reaction, user = await bot.wait_for('reaction_add', timeout=timeout, check=check)
-        except asyncio.TimeoutError:
-            break
+            await self.message.edit(embed=await self.render('Timed out'), view=None)
 
-        await reaction.remove(user)
+        except discord.HTTPException:
+            pass  # Message was deleted
 
-        # Change page
-        if reaction.emoji == '⬅':
-            if current_page == 1:
-                continue
-            current_page -= 1
 
-        elif reaction.emoji == '➡':
-            if current_page == len(pages):
-                continue
-            current_page += 1
+async def send_paginated_embed(
+    bot: discord.ext.commands.Bot,
+    channel: discord.TextChannel,
+    fields: typing.Union[typing.Iterable[typing.Dict], typing.AsyncIterable[typing.Dict]],  # name, value, inline
+    *,
+    owner: typing.Optional[discord.User] = None,
+    timeout: int = 600,
+    title: typing.Optional[str] = '',
+    description: typing.Optional[str] = None,
+    color: typing.Union[discord.Colour, int, None] = None,
+    author: typing.Optional[typing.Dict] = None,
+    page_character_limit: typing.Optional[int] = 6000,
+) -> discord.Message:  # author = name: str, icon_url: optional str
+    '''
+    Displays a paginated embed of given fields with page buttons, optionally locked to an owner, until timed out.
+    Pages are built from the fields as they are viewed. Button presses are routed to the paginator by discord.py's
+    view store, which is keyed by message ID
+    '''
+    # Find the page character cap
+    footer_max_length = (
+        len(Paginator.PAGE_TEMPLATE) + len(Paginator.FOOTER_ENDED_BY.format('-' * 37)) + 14
+    )  # 37 = max len(discordtag...#0000), 14 = page numbers and spacing
+    title_max_length = len(title) + len(Paginator.PAGE_TEMPLATE) + 11
+    description_length = 0 if not description else len(description)
+    author_length = 0 if not author else len(author['name'])
 
-        else:
-            ended_by = user
-            break
+    page_char_cap = page_character_limit - footer_max_length - title_max_length - description_length - author_length
+
+    # Init embed
+    embed = discord.Embed(description=None if not description else description, colour=color)
+    if author:
+        embed.set_author(name=author['name'], icon_url=None if not 'icon_url' in author else author['icon_url'])
+    embed.set_footer(icon_url=None if not owner else owner.display_avatar.url)
 
-    if not (single_page or dm_channel):
-        # Generate ended footer
-        page_text = PAGE_TEMPLATE.format(current_page, len(pages))
-        footer_text = FOOTER_ENDED_BY.format(ended_by) if ended_by else 'Timed out'
-        embed.set_footer(text=f'{page_text}    {footer_text}', icon_url=embed.footer.icon_url)
+    source = PageSource(fields, page_char_cap)
+    paginator = Paginator(source, embed, title, owner=owner, timeout=timeout)
+    await source.get(0)
+
+    if source.done and len(source.pages) <= 1:
+        return await channel.send(embed=await paginator.render())
+
+    if not isinstance(channel, (discord.TextChannel, discord.Thread)):
+        # DM channel, buttons are not used so send each page up to a limit. Pages are counted first so each one
+        # shows the total
+        total = await source.count()
+        message = None
+        while paginator.current < min(total, 10):
+            message = await channel.send(embed=await paginator.render())
+            paginator.current += 1
+
+        remaining = total - 10
+        if remaining > 0:
+            await channel.send(
+                f'Limited to 10 pages in DM channel. {remaining} page{"s were" if remaining != 1 else " was"} not sent'
+            )
 
-        await message.clear_reactions()
-        await message.edit(embed=embed)
+        return message
 
-    return message
+    paginator.message = await channel.send(embed=await paginator.render(), view=paginator)
+    return paginator.message
 
 
-def convert_list_to_fields(lines: str, codeblock: bool = True) -> typing.List[typing.Dict]:
-    fields = []
+def iter_fields(lines: typing.Iterable[str], codeblock: bool = True) -> typing.Iterator[typing.Dict]:
+    '''
+    Packs lines into embed fields of up to 1024 characters in a single pass over any iterable, so it can feed
+    send_paginated_embed lazily. A line too long for a field on its own is split across fields
+    '''
+    wrapper = '```' if codeblock else ''
+    capacity = 1024 - len(wrapper) * 2
+    chunk = []
+    size = 0
 
-    while lines:
-        value = '```' if codeblock else ''
+    for line in lines:
+        for start in range(0, max(len(line), 1), capacity - 1):
+            piece = line[start : start + capacity - 1] + '\n'
+            if size + len(piece) > capacity:
+                # \uFEFF = ZERO WIDTH NO-BREAK SPACE
+                yield {'name': '\uFEFF', 'value': wrapper + ''.join(chunk) + wrapper, 'inline': False}
+                chunk = []
+                size = 0
 
-        for line in lines.copy():
-            staged = value + line + '\n'
-            if len(staged) + (3 if codeblock else 0) > 1024:
-                break
+            chunk.append(piece)
+            size += len(piece)
 
-            lines.pop(0)
-            value = staged
+    if chunk:
+        yield {'name': '\uFEFF', 'value': wrapper + ''.join(chunk) + wrapper, 'inline': False}
 
-        value += '```' if codeblock else ''
-        fields.append({'name': '\uFEFF', 'value': value, 'inline': False})  # \uFEFF = ZERO WIDTH NO-BREAK SPACE
 
-    return fields
+def convert_list_to_fields(lines: typing.Iterable[str], codeblock: bool = True) -> typing.List[typing.Dict]:
+    return list(iter_fields(lines, codeblock))
 
 
 class ResolveUser(discord.ext.commands.Converter):
@@ -849,15 +1974,49 @@ class ResolveUser(discord.ext.commands.Converter):
 
             userid = int(mention.group(1))
 
-        try:
-            member = ctx.guild.get_member(userid)
-            user = await ctx.bot.fetch_user(argument) if not member else member
+        user = ctx.bot.resolver.get(userid, ctx.guild)
+        if isinstance(user, discord.Member):
             return user
 
+        try:
+            if not ctx.guild.chunked:  # Lazy member mode, the member may exist but not be cached yet
+                try:
+                    return await ctx.guild.fetch_member(userid)
+
+                except discord.NotFound:
+                    pass
+
+            return user or await ctx.bot.resolver.fetch(userid)
+
         except discord.NotFound:
             raise discord.ext.commands.BadArgument
 
 
+class ResolveMemberName(discord.ext.commands.Converter):
+    '''
+    Resolves a guild member by a current username, global name or nickname, compared normalised. Opt-in and only for
+    single arguments, never inside Greedy where a word of free text could match someone's name. IDs and mentions are
+    rejected so they are left to the converters after it, place it first in a Union so names are looked up in the name
+    index before discord.py's member converter scans the guild
+    '''
+
+    async def convert(self, ctx, argument):
+        if argument.isdigit() or re.fullmatch(r'<@!?\d+>', argument):
+            raise discord.ext.commands.BadArgument
+
+        key = normalize_name(argument)
+        members = []
+        for member in map(ctx.guild.get_member, ctx.bot.names.find(argument)):
+            # The index also holds past names, only a name the member has right now counts
+            if member and key in {normalize_name(x) for x in (member.name, member.global_name, member.nick) if x}:
+                members.append(member)
+
+        if len(members) != 1:
+            raise discord.ext.commands.BadArgument
+
+        return members[0]
+
+
 async def setup(bot):
     logging.info('[Extension] Utils module loaded')
 